@@ -0,0 +1,194 @@
+import hashlib
+import os
+
+import spacy
+
+from cache import SQLiteCache
+from spacy.tokens import DocBin
+
+"""
+This file contains the spaCy annotation used by the feature extraction methods. Two pipelines are loaded:
+the full pipeline parses the sentences of the dependency-tree method, and a lighter pipeline without the parser
+and the named entity recogniser finds the lemmas of the word-distribution and word-embedding methods. The
+word-embedding method still tags those lemmas with nltk, as its classifier was trained on nltk tags. For corpus
+runs, parsed documents can be cached on disk as DocBins and lemmas in an SQLite cache, both of bounded size
+"""
+
+nlp = spacy.load("en_core_web_sm")
+lemmatiser = spacy.load("en_core_web_sm", disable=["parser", "ner"])  # Lemmas and tags do not need the parse
+ANNOTATION_CACHE_DIR = "annotation_cache"
+DOC_CACHE_MAX_BYTES = 2 * 1024 ** 3  # Parsed documents kept on disk, the least recently used are deleted beyond it
+lemma_cache = SQLiteCache(os.path.join(ANNOTATION_CACHE_DIR, "lemmas.sqlite"), max_entries=200000)
+
+
+def content_hash(texts):
+    """
+    Computes a hash of a list of texts and of the pipeline that parses them
+    :param texts: list <str>
+    :return: str
+    """
+    h = hashlib.sha256()
+    h.update("{}-{}".format(nlp.meta["name"], nlp.meta["version"]).encode("utf-8"))
+    for text in texts:
+        h.update(b"\0")
+        h.update(text.encode("utf-8"))
+    return h.hexdigest()
+
+
+def evict_doc_bins(cache_dir=ANNOTATION_CACHE_DIR, max_bytes=DOC_CACHE_MAX_BYTES):
+    """
+    Deletes the least recently used DocBins of the cache directory until they take at most max_bytes
+    :param cache_dir: str
+    :param max_bytes: int
+    :return: None
+    """
+    doc_bins = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(".spacy"):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:  # Deleted by another process
+                continue
+            doc_bins.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in doc_bins)
+    for _, size, path in sorted(doc_bins):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def pipe_units(texts, batch_size=64, n_process=1, use_cache=False, cache_dir=ANNOTATION_CACHE_DIR):
+    """
+    Parses texts (e.g. the sentences or paragraphs of a document), yielding one Doc per text in order.
+    With use_cache the Docs are saved as a DocBin keyed by the hash of the texts, so a document that
+    has been parsed before is read from disk instead of being parsed again. The DocBins take at most
+    DOC_CACHE_MAX_BYTES, the least recently used are deleted first
+    :param texts: iterable <str>
+    :param batch_size: int
+    :param n_process: int
+    :param use_cache: bool
+    :param cache_dir: str
+    :return: generator <Doc>
+    """
+    if not use_cache:
+        yield from nlp.pipe(texts, batch_size=batch_size, n_process=n_process)
+        return
+
+    texts = list(texts)
+    path = os.path.join(cache_dir, content_hash(texts) + ".spacy")
+    try:
+        doc_bin = DocBin().from_disk(path)
+        os.utime(path)  # The modification time records the last use
+    except FileNotFoundError:  # Not parsed before, or deleted by eviction
+        pass
+    else:
+        yield from doc_bin.get_docs(nlp.vocab)
+        return
+
+    doc_bin = DocBin(store_user_data=False)
+    for doc in nlp.pipe(texts, batch_size=batch_size, n_process=n_process):
+        doc_bin.add(doc)
+        yield doc
+
+    # Only cache documents that were parsed to the end, writing to a temporary file first
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    doc_bin.to_disk(tmp_path)
+    os.replace(tmp_path, path)
+    evict_doc_bins(cache_dir)
+
+
+def annotate(text, use_cache=False):
+    """
+    Parses a single text
+    :param text: str
+    :param use_cache: bool
+    :return: Doc
+    """
+    return next(pipe_units([text], use_cache=use_cache))
+
+
+def is_word(token):
+    return token.is_alpha and not token.is_punct
+
+
+def lemmas(doc):
+    """
+    Finds the lowercase lemma of every word in a parsed text
+    :param doc: Doc
+    :return: list <str>
+    """
+    return [str(token.lemma_).lower() for token in doc if is_word(token)]
+
+
+def penn_tags(doc):
+    """
+    Finds the Penn Treebank tag of every word in a parsed text, aligned with lemmas(doc)
+    :param doc: Doc
+    :return: list <str>
+    """
+    return [token.tag_ for token in doc if is_word(token)]
+
+
+def lemmas_and_tags(doc):
+    """
+    Finds the lemmas and Penn Treebank tags of the words in a parsed text
+    :param doc: Doc
+    :return: list <str>, list <str>
+    """
+    return lemmas(doc), penn_tags(doc)
+
+
+def lemma_key(text):
+    """
+    Computes the key of a text in the lemma cache, ignoring differences in whitespace
+    :param text: str
+    :return: str
+    """
+    normalised = " ".join(text.split())
+    return content_hash([normalised])
+
+
+def lemmatise_batch(texts, use_cache=False):
+    """
+    Finds the lemmas and Penn Treebank tags of a batch of texts. With use_cache, only the texts missing
+    from the lemma cache on disk are lemmatised. The cache keeps the lemmas of every text it is given,
+    so it is only used for the corpus and never for uploaded documents
+    :param texts: list <str>
+    :param use_cache: bool
+    :return: list <(list<str>, list<str>)>
+    """
+    keys = [lemma_key(text) for text in texts]
+    found = lemma_cache.get_many(list(set(keys))) if use_cache else {}
+    missing = {key: text for key, text in zip(keys, texts) if key not in found}
+    if missing:
+        parsed = {key: lemmas_and_tags(doc) for key, doc in zip(missing, lemmatiser.pipe(missing.values()))}
+        if use_cache:
+            lemma_cache.set_many(parsed)
+        found.update(parsed)
+    return [found[key] for key in keys]
+
+
+def pipe_lemmas_and_tags(texts, batch_size=64, use_cache=False):
+    """
+    Finds the lemmas and Penn Treebank tags of texts in order. With use_cache, the lemma cache is consulted
+    before parsing, so that repeated lines such as headings and boilerplate are only parsed once across documents
+    :param texts: iterable <str>
+    :param batch_size: int
+    :param use_cache: bool
+    :return: generator <(list<str>, list<str>)>
+    """
+    batch = []
+    for text in texts:
+        batch.append(text)
+        if len(batch) == batch_size:
+            yield from lemmatise_batch(batch, use_cache)
+            batch = []
+    if batch:
+        yield from lemmatise_batch(batch, use_cache)
@@ -1,28 +1,182 @@
+import io
+import json
 import os
+import shutil
+import tempfile
 
-from flask import Flask, render_template, request, Response
-from main import detect
+from bulk import BulkRequestError, archive_documents, json_documents, result_line
+from flask import Flask, abort, jsonify, render_template, request, Response, send_file
+from jobs import JobManager, JobQueueFull
+from main import ENSEMBLE_PROCESSES, METHODS, start_ensemble_pool
+from model_registry import classifiers
+from prefork import WorkerPool
+from result_cache import ResultCache
+from segmentation import decode_text
 
 app = Flask(__name__)
+classifiers.load_all()  # Unpickle the classifiers once, before the first request
+result_cache = None
+if os.environ.get("DETECT_RESULT_CACHE", "1") == "1":
+    result_cache = ResultCache()
+    classifiers.add_listener(result_cache.invalidate)  # Results of a retrained classifier are computed again
+workers = None
+if int(os.environ.get("DETECT_PREFORK", 0)) > 0:
+    # Documents are analysed by warm processes forked before the first request, sharing the loaded models
+    # Every worker would start its own pool for the "all" method, so by default the workers run the methods
+    # of a document one after the other, as documents are already analysed in parallel by the workers
+    workers = WorkerPool(int(os.environ["DETECT_PREFORK"]), cache=result_cache,
+                         ensemble_processes=int(os.environ.get("DETECT_ENSEMBLE_PROCESSES", 0)))
+    workers.start()
+else:
+    # The processes of the "all" method are forked before the first request
+    start_ensemble_pool(int(os.environ.get("DETECT_ENSEMBLE_PROCESSES", ENSEMBLE_PROCESSES)))
+jobs = JobManager(max_workers=workers.size if workers is not None else int(os.environ.get("DETECT_WORKERS", 2)),
+                  max_queued=int(os.environ.get("DETECT_MAX_QUEUED", 16)),
+                  persist_results=os.environ.get("DETECT_PERSIST_RESULTS") == "1",
+                  result_mode=os.environ.get("DETECT_RESULT_MODE", "pdf"),
+                  cache=result_cache,
+                  workers=workers)
 
 
 @app.route("/", methods=["GET", "POST"])
 def main():
     if request.method == "POST":
-        file = request.files["file"]
-        method = request.form["method"]
-        file.save(os.path.join("static/uploaded_file/", file.filename))
-        return render_template("main.html", download="True", file=file.filename, method=method)
+        file = request.files.get("file")
+        method = request.form.get("method")
+        if file is None:
+            return "Choose a text file to analyse", 400
+        if method not in METHODS + ("all",):
+            return "Unknown method {}".format(method), 400
+        try:
+            # The upload is analysed in memory, without being saved. It is decoded before its job is created,
+            # so that a file that is not text does not hold a place in the queue
+            text = decode_text(file.read())
+        except UnicodeDecodeError:
+            return "{} is not a UTF-8 text file".format(file.filename), 400
+        try:
+            job = jobs.create(file.filename, method, text)
+        except JobQueueFull:
+            return "Too many documents are being analysed, please try again in a few minutes", 503
+        jobs.start(job)
+        return render_template("main.html", download="True", job_id=job.id, method=method,
+                               result_mode=job.result_mode)
 
     else:
-        return render_template("main.html", download="False", file=None, method=None)
+        return render_template("main.html", download="False", job_id=None, method=None)
 
 
-@app.route("/stream/<file>/<method>", methods=["GET"])
-def action(file, method):
-    response = Response(detect(file, method), mimetype="text/event-stream")
+@app.route("/job/<job_id>", methods=["GET"])
+def job_page(job_id):
+    # Reattach to a job, e.g. after reloading the page
+    job = jobs.get(job_id)
+    if job is None:
+        abort(404)
+    return render_template("main.html", download="True", job_id=job.id, method=job.method,
+                           result_mode=job.result_mode)
+
+
+@app.route("/stream/<job_id>", methods=["GET"])
+def action(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        abort(404)
+    # Browsers send the ID of the last event they received when they reconnect
+    last_event_id = request.headers.get("Last-Event-ID")
+    response = Response(job.subscribe(last_event_id), mimetype="text/event-stream")
     return response
 
 
+@app.route("/result/<job_id>", methods=["GET"])
+def result(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        abort(404)
+    pdf = jobs.result_pdf(job)  # Rendered on the first download in "spans" result mode
+    if pdf is None:
+        abort(404)
+    return send_file(io.BytesIO(pdf), mimetype="application/pdf")
+
+
+@app.route("/text/<job_id>", methods=["GET"])
+def text(job_id):
+    # The uploaded text, for the page to highlight the spans of the result
+    job = jobs.get(job_id)
+    if job is None or job.text is None:
+        abort(404)
+    return Response(job.text, mimetype="text/plain; charset=utf-8")
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify({"id": job.id, "method": job.method, "filename": job.filename, "status": job.status,
+                    "events": len(job.events), "result_mode": job.result_mode, "spans": job.spans})
+
+
+@app.route("/api/detect", methods=["POST"])
+def bulk_detect():
+    # A JSON batch {"method": ..., "documents": [...]}, or an "archive" file and a "method" field
+    if request.is_json:
+        body = request.get_json(silent=True)
+        method = body.get("method") if isinstance(body, dict) else None
+    else:
+        body = None
+        method = request.form.get("method")
+    if method not in METHODS + ("all",):
+        return jsonify({"error": "Unknown method {}".format(method)}), 400
+
+    archive = None
+    try:
+        if request.is_json:
+            documents = json_documents(body)
+        elif "archive" in request.files:
+            # Flask closes the upload once this view returns, but the documents are only read as they are analysed,
+            # so the archive is copied to a temporary file on disk instead of being read into memory
+            archive = tempfile.TemporaryFile()
+            shutil.copyfileobj(request.files["archive"].stream, archive)
+            documents = archive_documents(archive)
+        else:
+            return jsonify({"error": "Send a JSON batch or an archive"}), 400
+    except BulkRequestError as e:
+        if archive is not None:
+            archive.close()
+        return jsonify({"error": str(e)}), 400
+
+    if jobs.is_full():
+        if archive is not None:
+            archive.close()
+        response = jsonify({"error": "Too many documents are being analysed"})
+        response.headers["Retry-After"] = "30"
+        return response, 503
+
+    def results():
+        try:
+            for job in jobs.run_batch(documents, method):
+                if job is None:
+                    yield json.dumps({"keepalive": True}) + "\n"  # Lets the server notice clients that went away
+                else:
+                    yield result_line(job)  # One line per document, as soon as it is analysed
+        except BulkRequestError as e:
+            yield json.dumps({"error": str(e)}) + "\n"
+        finally:
+            if archive is not None:
+                archive.close()
+
+    return Response(results(), mimetype="application/x-ndjson")
+
+
+@app.route("/health", methods=["GET"])
+def health():
+    if workers is not None:
+        # The classifiers and the hits of the result cache of the web app are not used, every worker reports its own
+        return jsonify({"status": "ok", "workers": workers.health()})
+    report = {"status": "ok", "models": classifiers.health()}
+    if result_cache is not None:
+        report["result_cache"] = result_cache.stats()
+    return jsonify(report)
+
+
 if __name__ == "__main__":
     app.run()
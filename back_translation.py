@@ -1,48 +1,318 @@
-from nltk import tokenize
+import hashlib
+import json
+import os
+import sys
+import threading
+import torch
+
+import numpy as np
+
+from cache import SQLiteCache
+from collections import Counter
 from nltk.translate.bleu_score import sentence_bleu
 from transformers import FSMTForConditionalGeneration, FSMTTokenizer
 
+MODEL_NAMES = ["facebook/wmt19-en-de", "facebook/wmt19-de-en"]
+GENERATION_SETTINGS = {}  # Arguments of model.generate(), empty to use the defaults of the models
+GREEDY_SETTINGS = {"num_beams": 1}  # Greedy decoding instead of beam search, for the fast mode
+
+# Weights of the individual 1- to 4-gram scores and of the cumulative 2- to 4-gram scores
+BLEU_WEIGHTS = np.array([(1, 0, 0, 0), (0, 1, 0, 0), (0, 0, 1, 0), (0, 0, 0, 1),
+                         (0.5, 0.5, 0, 0), (0.33, 0.33, 0.33, 0), (0.25, 0.25, 0.25, 0.25)])
+MAX_NGRAM = 4
+
+bt_cache = SQLiteCache("back_translation/bt_cache.sqlite", max_entries=500000)
+
+
+class TranslatorRegistry:
+    def __init__(self, model_dir=None):
+        self.model_dir = model_dir  # Directory with a copy of the models, for working offline
+        self.translators = {}
+        self.lock = threading.Lock()
+
+    def model_path(self, mname):
+        """
+        Finds where to load a model from: the local model directory if it has the model, otherwise the hub
+        :param mname: str
+        :return: str
+        """
+        if self.model_dir is not None:
+            path = os.path.join(self.model_dir, mname)
+            if os.path.isdir(path):
+                return path
+        return mname
+
+    def load(self, mname, quantize=False):
+        """
+        Loads the tokenizer and model of a translation direction in evaluation mode.
+        With quantize, the linear layers of the model are dynamically quantized to int8 for faster CPU inference
+        :param mname: str
+        :param quantize: bool
+        :return: FSMTTokenizer, FSMTForConditionalGeneration
+        """
+        path = self.model_path(mname)
+        local_files_only = path != mname
+        tokenizer = FSMTTokenizer.from_pretrained(path, local_files_only=local_files_only)
+        model = FSMTForConditionalGeneration.from_pretrained(path, local_files_only=local_files_only)
+        model.eval()
+        if quantize:
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        return tokenizer, model
 
-def split_into_sentences(path):
+    def get(self, mname, quantize=False):
+        """
+        Returns the tokenizer and model of a translation direction, loading them the first time.
+        Safe to call from several threads, the models are only loaded once
+        :param mname: str
+        :param quantize: bool
+        :return: FSMTTokenizer, FSMTForConditionalGeneration
+        """
+        translator = self.translators.get((mname, quantize))
+        if translator is None:
+            with self.lock:
+                translator = self.translators.get((mname, quantize))
+                if translator is None:
+                    translator = self.load(mname, quantize)
+                    self.translators[(mname, quantize)] = translator
+        return translator
+
+    def preload(self, model_dir=None):
+        """
+        Loads both translation directions up front, optionally from a local model directory
+        :param model_dir: str or NoneType
+        :return: None
+        """
+        if model_dir is not None:
+            self.model_dir = model_dir
+        for mname in MODEL_NAMES:
+            self.get(mname)
+
+    def save(self, model_dir):
+        """
+        Saves both translation directions to a local model directory, so they can be loaded offline
+        :param model_dir: str
+        :return: None
+        """
+        for mname in MODEL_NAMES:
+            tokenizer, model = self.get(mname)
+            tokenizer.save_pretrained(os.path.join(model_dir, mname))
+            model.save_pretrained(os.path.join(model_dir, mname))
+
+
+registry = TranslatorRegistry(model_dir=os.environ.get("BACK_TRANSLATION_MODEL_DIR"))
+
+
+def set_num_threads(num_threads):
     """
-    Splits a given .txt file to a list of sentences.
-    :param path: str
-    :return: list <str>
+    Sets the number of CPU threads used by the translation models
+    :param num_threads: int
+    :return: None
+    """
+    torch.set_num_threads(num_threads)
+
+
+def generation_settings(greedy=False):
     """
-    with open(path, mode="r", encoding="utf-8") as f:
-        text = f.read()
-        text = text.replace("\n", " ")
-        sentences = tokenize.sent_tokenize(text)
-        return sentences
+    Finds the arguments of model.generate(), using greedy decoding in the fast mode
+    :param greedy: bool
+    :return: dict
+    """
+    if greedy:
+        return dict(GENERATION_SETTINGS, **GREEDY_SETTINGS)
+    return GENERATION_SETTINGS
 
 
-def translate(input, mname):
+def translate(input, mname, quantize=False, greedy=False):
     """
-    Translates a sentence using the transformer model to the desired target language
+    Translates a sentence using the transformer model to the desired target language.
+    quantize and greedy turn on the fast mode: int8 linear layers and greedy decoding
     :param input:  str
     :param mname: str
+    :param quantize: bool
+    :param greedy: bool
     :return: str
     """
-    tokenizer = FSMTTokenizer.from_pretrained(mname)
-    model = FSMTForConditionalGeneration.from_pretrained(mname)
+    tokenizer, model = registry.get(mname, quantize)
     input_ids = tokenizer.encode(input, return_tensors="pt")
-    outputs = model.generate(input_ids)
+    with torch.no_grad():
+        outputs = model.generate(input_ids, **generation_settings(greedy))
     decoded = tokenizer.decode(outputs[0], skip_special_tokens=True)
     return decoded
 
 
-def back_translate(text):
+def make_batches(lengths, max_tokens):
+    """
+    Groups sequences sorted by length into batches whose padded size (number of sequences times
+    the longest length) stays within a token budget
+    :param lengths: list <int>
+    :param max_tokens: int
+    :return: list <list<int>>, the indices of the sequences in each batch
+    """
+    batches = []
+    batch = []
+    for i in sorted(range(len(lengths)), key=lengths.__getitem__):
+        if batch and (len(batch) + 1) * lengths[i] > max_tokens:
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def translate_batch(inputs, mname, max_tokens=2048, quantize=False, greedy=False):
+    """
+    Translates many sentences in padded batches of similar length, returning them in input order
+    :param inputs: list <str>
+    :param mname: str
+    :param max_tokens: int
+    :param quantize: bool
+    :param greedy: bool
+    :return: list <str>
+    """
+    tokenizer, model = registry.get(mname, quantize)
+    encoded = [tokenizer.encode(text) for text in inputs]
+    decoded = [None] * len(inputs)
+    for batch in make_batches([len(ids) for ids in encoded], max_tokens):
+        padded = tokenizer.pad({"input_ids": [encoded[i] for i in batch]}, return_tensors="pt")
+        with torch.no_grad():
+            outputs = model.generate(**padded, **generation_settings(greedy))
+        for i, output in zip(batch, outputs):
+            decoded[i] = tokenizer.decode(output, skip_special_tokens=True)
+    return decoded
+
+
+def bt_cache_key(text, quantize=False, greedy=False):
+    """
+    Computes the key of a sentence in the back-translation cache, which also depends on the models
+    and generation settings used
+    :param text: str
+    :param quantize: bool
+    :param greedy: bool
+    :return: str
+    """
+    settings = [text, MODEL_NAMES, generation_settings(greedy)] + (["int8"] if quantize else [])
+    key = json.dumps(settings, sort_keys=True)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def back_translate_batch(texts, max_tokens=2048, quantize=False, greedy=False):
+    """
+    Performs back translation on many sentences from English to German, back to English.
+    Sentences found in the back-translation cache are not translated again
+    :param texts: list <str>
+    :param max_tokens: int
+    :param quantize: bool
+    :param greedy: bool
+    :return: list <str>
+    """
+    keys = [bt_cache_key(text, quantize, greedy) for text in texts]
+    found = bt_cache.get_many(list(set(keys)))
+    missing = {key: text for key, text in zip(keys, texts) if key not in found}
+
+    if missing:
+        first_translations = translate_batch(list(missing.values()), MODEL_NAMES[0], max_tokens, quantize, greedy)
+        back_translations = translate_batch(first_translations, MODEL_NAMES[1], max_tokens, quantize, greedy)
+        translated = {key: (first, back) for key, first, back in zip(missing, first_translations, back_translations)}
+        bt_cache.set_many(translated)  # Stores the German translation and the English back-translation
+        found.update(translated)
+    return [found[key][1] for key in keys]
+
+
+def back_translate(text, quantize=False, greedy=False):
     """
     Performs back translation on a sentence from English to German, back to English
     :param text: str
+    :param quantize: bool
+    :param greedy: bool
     :return: str
     """
-    first_translation = translate(input=text, mname="facebook/wmt19-en-de")  # translate text to german
-    back_translation = translate(input=first_translation,
-                                 mname="facebook/wmt19-de-en")  # translate text back to english
+    key = bt_cache_key(text, quantize, greedy)
+    cached = bt_cache.get(key)
+    if cached is not None:
+        return cached[1]
+
+    first_translation = translate(input=text, mname="facebook/wmt19-en-de",
+                                  quantize=quantize, greedy=greedy)  # translate text to german
+    back_translation = translate(input=first_translation, mname="facebook/wmt19-de-en",
+                                 quantize=quantize, greedy=greedy)  # translate text back to english
+    bt_cache.set(key, (first_translation, back_translation))
     return back_translation
 
 
+def ngram_match_counts(reference, hypothesis, max_n=MAX_NGRAM):
+    """
+    Counts, for every n-gram order, the n-grams of the hypothesis and how many of them are matched in the
+    reference, clipping the count of each n-gram to its count in the reference
+    :param reference: list <str>
+    :param hypothesis: list <str>
+    :param max_n: int
+    :return: list <int>, list <int>
+    """
+    matches = []
+    totals = []
+    for n in range(1, max_n + 1):
+        hypothesis_counts = Counter(zip(*[hypothesis[i:] for i in range(n)]))
+        reference_counts = Counter(zip(*[reference[i:] for i in range(n)]))
+        matches.append(sum(min(count, reference_counts[ngram]) for ngram, count in hypothesis_counts.items()))
+        totals.append(sum(hypothesis_counts.values()))
+    return matches, totals
+
+
+def bleu_scores(matches, totals, hypothesis_lengths, reference_lengths, weights=BLEU_WEIGHTS):
+    """
+    Computes the BLEU scores of many sentence pairs at once from their n-gram counts, with the same
+    semantics as NLTK's sentence_bleu without smoothing
+    :param matches: numpy.ndarray <int> (pairs x n-gram orders)
+    :param totals: numpy.ndarray <int> (pairs x n-gram orders)
+    :param hypothesis_lengths: numpy.ndarray <int>
+    :param reference_lengths: numpy.ndarray <int>
+    :param weights: numpy.ndarray <float> (scores x n-gram orders)
+    :return: numpy.ndarray <float> (pairs x scores)
+    """
+    matches = np.asarray(matches, dtype=float)
+    precisions = matches / np.maximum(np.asarray(totals, dtype=float), 1)
+    precisions[matches == 0] = sys.float_info.min  # NLTK's replacement for a zero precision, so log() is defined
+    scores = np.exp(np.log(precisions) @ weights.T)
+
+    # Brevity penalty
+    c = np.asarray(hypothesis_lengths, dtype=float)
+    r = np.asarray(reference_lengths, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        penalty = np.where(c > r, 1.0, np.exp(1 - r / np.where(c > 0, c, 1)))
+    penalty[c == 0] = 0.0
+
+    scores *= penalty[:, None]
+    scores[matches[:, 0] == 0] = 0.0  # No unigram matches at all
+    return scores
+
+
+def back_translation_feature_extraction_batch(source_texts, back_translations):
+    """
+    Calculates the individual and cumulative n-gram scores for many sentences and their back-translations.
+    The n-gram matches of each pair are counted once and all the scores are derived from those counts
+    :param source_texts: list <str>
+    :param back_translations: list <str>
+    :return: list <list<float>>
+    """
+    matches = []
+    totals = []
+    hypothesis_lengths = []
+    reference_lengths = []
+    for source_text, back_translation in zip(source_texts, back_translations):
+        reference = source_text.split()
+        hypothesis = back_translation.split()
+        m, t = ngram_match_counts(reference, hypothesis)
+        matches.append(m)
+        totals.append(t)
+        hypothesis_lengths.append(len(hypothesis))
+        reference_lengths.append(len(reference))
+
+    if not matches:
+        return []
+    return bleu_scores(np.array(matches), np.array(totals), hypothesis_lengths, reference_lengths).tolist()
+
+
 def back_translation_feature_extraction(source_text, back_translation):
     """
     Calculates the individual and cumulative n-gram scores for a sentence and its back-translation
@@ -50,7 +320,17 @@ def back_translation_feature_extraction(source_text, back_translation):
     :param back_translation: str
     :return: list <float>
     """
+    return back_translation_feature_extraction_batch([source_text], [back_translation])[0]
 
+
+def back_translation_feature_extraction_nltk(source_text, back_translation):
+    """
+    Calculates the same scores as back_translation_feature_extraction with one call to NLTK per score,
+    kept as a reference implementation
+    :param source_text: str
+    :param back_translation: str
+    :return: list <float>
+    """
     # Split into array of words by spaces
     source_text_array = [source_text.split()]
     back_translation_array = back_translation.split()
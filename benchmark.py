@@ -0,0 +1,323 @@
+import os
+import sys
+import time
+
+import numpy as np
+import pandas
+
+from back_translation import back_translation_feature_extraction_batch, back_translation_feature_extraction_nltk, \
+    registry, set_num_threads, translate, translate_batch, MODEL_NAMES
+from concurrent.futures import ThreadPoolExecutor
+from dependency_tree import dependency_tree_feature_extraction_batch
+from embedding_store import EmbeddingStore, GLOVE_STORE, PRUNED_GLOVE_STORE
+from main import detect_text, predict_in_chunks, word_embedding_rows
+from model_registry import classifiers
+from prefork import WorkerPool
+from segmentation import iter_paragraph_spans, read_chunks, split_into_paragraphs, split_into_sentences
+from word_embedding import lemmatise, read_glove_pkl, word_embedding_feature_extraction, \
+    word_embedding_feature_extraction_loop, collect_corpus_lemmas, get_glove_store, save_pruned_glove_store
+
+# This file contains functions that measure the speed of the feature extraction methods
+
+
+def time_function(function, *args, repeat=3):
+    """
+    Runs a function several times and returns the fastest running time and the last result
+    :param function: function
+    :param args: any
+    :param repeat: int
+    :return: float, any
+    """
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def random_paragraphs(n_paragraphs=20, n_lemmas=300, vocabulary=5000, dimensions=50, seed=0):
+    """
+    Makes paragraphs of random words with random embeddings, so that the word-embedding features can be
+    benchmarked without the chapters and the GloVe embeddings
+    :param n_paragraphs: int
+    :param n_lemmas: int, words per paragraph
+    :param vocabulary: int
+    :param dimensions: int
+    :param seed: int
+    :return: list <list<str>>, dict <str, np.array>
+    """
+    random = np.random.RandomState(seed)
+    words = ["word{}".format(i) for i in range(vocabulary)]
+    glove_dict = {word: random.normal(size=dimensions) for word in words}
+    paragraphs = [[words[i] for i in random.randint(0, vocabulary, n_lemmas)] for _ in range(n_paragraphs)]
+    return paragraphs, glove_dict
+
+
+def benchmark_word_embedding(path="dataset/english_chapters/11-chapters/01.txt", paragraphs=None, glove_dict=None):
+    """
+    Compares the pairwise loop against the vectorised word-embedding feature extraction on a chapter,
+    or on the given paragraphs of lemmas and embeddings, see random_paragraphs
+    :param path: str
+    :param paragraphs: list <list<str>> or NoneType
+    :param glove_dict: dict or NoneType
+    :return: None
+    """
+    if glove_dict is None:
+        glove_dict = read_glove_pkl()
+    if paragraphs is None:
+        paragraphs = [lemmatise(p) for p in split_into_paragraphs(path)]
+    paragraphs = [lemmas for lemmas in paragraphs if len(lemmas) > 50]
+
+    loop_time = 0.0
+    vectorised_time = 0.0
+    max_difference = 0.0
+    for lemmas in paragraphs:
+        t1, expected = time_function(word_embedding_feature_extraction_loop, lemmas, glove_dict)
+        t2, actual = time_function(word_embedding_feature_extraction, lemmas, glove_dict)
+        loop_time += t1
+        vectorised_time += t2
+        max_difference = max(max_difference, np.max(np.abs(np.array(expected) - np.array(actual))))
+
+    print("Paragraphs:", len(paragraphs))
+    print("Loop (s):", loop_time)
+    print("Vectorised (s):", vectorised_time)
+    print("Speedup:", loop_time / vectorised_time)
+    print("Max absolute difference:", max_difference)
+
+
+def store_memory(store):
+    """
+    Estimates the memory in bytes taken by the vectors and the word index of an embedding store
+    :param store: EmbeddingStore
+    :return: int, int
+    """
+    index_memory = sys.getsizeof(store.index) + sum(sys.getsizeof(word) for word in store.index)
+    return store.matrix.nbytes, index_memory
+
+
+def load_store(path):
+    """
+    Loads an embedding store and reads every page of its vectors
+    :param path: str
+    :return: EmbeddingStore
+    """
+    store = EmbeddingStore(path)
+    np.asarray(store.matrix).sum()
+    return store
+
+
+def benchmark_pruned_glove_store(path="dataset/english_chapters/11-chapters/01.txt", reserve=20000):
+    """
+    Reports how much memory and load time the pruned GloVe stores save, and how much the
+    word-embedding features of a chapter drift when the vectors are stored as float16
+    :param path: str
+    :param reserve: int
+    :return: None
+    """
+    corpus_lemmas = collect_corpus_lemmas()
+    get_glove_store(GLOVE_STORE)  # Builds the full store if needed
+    save_pruned_glove_store(corpus_lemmas, reserve, dtype="float32", store_path=PRUNED_GLOVE_STORE + ".float32")
+    save_pruned_glove_store(corpus_lemmas, reserve, dtype="float16", store_path=PRUNED_GLOVE_STORE + ".float16")
+
+    pickle_time, _ = time_function(read_glove_pkl, repeat=1)
+    print("Pickle load (s):", pickle_time)
+
+    stores = {}
+    for name, store_path in [("full float32", GLOVE_STORE),
+                             ("pruned float32", PRUNED_GLOVE_STORE + ".float32"),
+                             ("pruned float16", PRUNED_GLOVE_STORE + ".float16")]:
+        load_time, stores[name] = time_function(load_store, store_path, repeat=1)
+        vectors_memory, index_memory = store_memory(stores[name])
+        print(name, "words:", len(stores[name]), "vectors (MB):", vectors_memory / 2 ** 20,
+              "index (MB):", index_memory / 2 ** 20, "load (s):", load_time)
+
+    paragraphs = [lemmatise(p) for p in split_into_paragraphs(path)]
+    paragraphs = [lemmas for lemmas in paragraphs if len(lemmas) > 50]
+    for name in ["pruned float32", "pruned float16"]:
+        max_difference = 0.0
+        max_relative_difference = 0.0
+        for lemmas in paragraphs:
+            expected = np.array(word_embedding_feature_extraction(lemmas, stores["full float32"]))
+            actual = np.array(word_embedding_feature_extraction(lemmas, stores[name]))
+            difference = np.abs(expected - actual)
+            max_difference = max(max_difference, difference.max())
+            max_relative_difference = max(max_relative_difference,
+                                          (difference / np.maximum(np.abs(expected), 1e-12)).max())
+        print(name, "max absolute drift:", max_difference, "max relative drift:", max_relative_difference)
+
+
+def benchmark_back_translation(path="dataset/english_chapters/11-chapters/01.txt", n_sentences=64,
+                               max_tokens=2048):
+    """
+    Compares the throughput of back-translating sentences one at a time and in batches.
+    Both translate directly rather than through back_translate and back_translate_batch, so that neither
+    is timed on the back-translation cache, which the first would otherwise fill for the second
+    :param path: str
+    :param n_sentences: int
+    :param max_tokens: int
+    :return: None
+    """
+    sentences = [s for s in split_into_sentences(path) if len(s.split()) > 5][:n_sentences]
+    for mname in MODEL_NAMES:
+        registry.get(mname)  # Load the models before timing
+
+    def one_at_a_time():
+        return [translate(translate(s, MODEL_NAMES[0]), MODEL_NAMES[1]) for s in sentences]
+
+    def batched():
+        german = translate_batch(sentences, MODEL_NAMES[0], max_tokens)
+        return translate_batch(german, MODEL_NAMES[1], max_tokens)
+
+    single_time, _ = time_function(one_at_a_time, repeat=1)
+    batch_time, _ = time_function(batched, repeat=1)
+    print("Sentences:", len(sentences))
+    print("Per sentence (sentences/s):", len(sentences) / single_time)
+    print("Batched (sentences/s):", len(sentences) / batch_time)
+    print("Speedup:", single_time / batch_time)
+
+
+def resident_memory():
+    """
+    Finds the resident memory of the current process in bytes (Linux only)
+    :return: int
+    """
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def benchmark_fast_back_translation(path="dataset/english_chapters/11-chapters/01.txt", n_sentences=64,
+                                    num_threads=None):
+    """
+    Reports the throughput, resident memory and shift of the seven BLEU features of the fast back-translation
+    modes (int8 quantized models and/or greedy decoding) against the default float32 beam search
+    :param path: str
+    :param n_sentences: int
+    :param num_threads: int or NoneType
+    :return: None
+    """
+    if num_threads is not None:
+        set_num_threads(num_threads)
+    sentences = [s for s in split_into_sentences(path) if len(s.split()) > 5][:n_sentences]
+
+    baseline = None
+    for quantize, greedy in [(False, False), (True, False), (False, True), (True, True)]:
+        memory_before = resident_memory()
+        for mname in MODEL_NAMES:
+            registry.get(mname, quantize)
+        model_memory = resident_memory() - memory_before  # Zero if the models were loaded by a previous mode
+
+        # Translate directly rather than through back_translate_batch, so that the cache is not used
+        start = time.perf_counter()
+        german = translate_batch(sentences, MODEL_NAMES[0], quantize=quantize, greedy=greedy)
+        english = translate_batch(german, MODEL_NAMES[1], quantize=quantize, greedy=greedy)
+        elapsed = time.perf_counter() - start
+
+        features = np.array(back_translation_feature_extraction_batch(sentences, english))
+        if baseline is None:
+            baseline = features
+        shift = np.abs(features - baseline)
+        print("quantize:", quantize, "greedy:", greedy)
+        print("  Throughput (sentences/s):", len(sentences) / elapsed)
+        print("  Models resident memory (MB):", model_memory / 2 ** 20, "process (MB):", resident_memory() / 2 ** 20)
+        print("  Mean absolute BLEU feature shift:", shift.mean(axis=0).round(4).tolist())
+        print("  Max absolute BLEU feature shift:", shift.max(axis=0).round(4).tolist())
+
+
+def benchmark_bleu_kernel(path="dataset/english_chapters/11-chapters/01.txt", n_sentences=5000, sentences=None):
+    """
+    Compares seven NLTK sentence_bleu calls per sentence pair against the single-pass BLEU kernel.
+    The sentences of a chapter, or the given sentences, are paired with a shuffled copy of themselves,
+    so no translation model is needed
+    :param path: str
+    :param n_sentences: int
+    :param sentences: list <str> or NoneType
+    :return: None
+    """
+    if sentences is None:
+        sentences = split_into_sentences(path)
+    sentences = [s for s in sentences if len(s.split()) > 5]
+    sentences = (sentences * (n_sentences // max(1, len(sentences)) + 1))[:n_sentences]
+    hypotheses = [" ".join(np.random.RandomState(i).permutation(s.split())) for i, s in enumerate(sentences)]
+
+    nltk_time, expected = time_function(
+        lambda: [back_translation_feature_extraction_nltk(s, h) for s, h in zip(sentences, hypotheses)], repeat=1)
+    kernel_time, actual = time_function(back_translation_feature_extraction_batch, sentences, hypotheses)
+    print("Sentence pairs:", len(sentences))
+    print("NLTK (pairs/s):", len(sentences) / nltk_time)
+    print("Kernel (pairs/s):", len(sentences) / kernel_time)
+    print("Speedup:", nltk_time / kernel_time)
+    print("Max absolute difference:", np.max(np.abs(np.array(expected) - np.array(actual))))
+
+
+def benchmark_batched_inference(path="dataset/english_chapters/54-chapters/095.txt", method="dependency_tree"):
+    """
+    Compares classifying the sentences or paragraphs of a long chapter one DataFrame row at a time
+    against classifying them in chunks, and checks that every prediction is the same
+    :param path: str
+    :param method: str
+    :return: None
+    """
+    model = classifiers.get(method)
+    if method == "dependency_tree":
+        sentences = [s for s in split_into_sentences(path) if len(s.split()) > 5]
+        items = list(zip(sentences, dependency_tree_feature_extraction_batch(sentences)))
+    else:
+        items = list(word_embedding_rows(iter_paragraph_spans("".join(read_chunks(path)))))
+
+    row_time, expected = time_function(lambda: [model.predict(pandas.DataFrame([features]))[0]
+                                                for _, features in items])
+    chunk_time, actual = time_function(lambda: [prediction for _, prediction in predict_in_chunks(model, items)])
+    print("Rows:", len(items))
+    print("One row at a time (rows/s):", len(items) / row_time)
+    print("In chunks (rows/s):", len(items) / chunk_time)
+    print("Speedup:", row_time / chunk_time)
+    print("Identical predictions:", list(expected) == list(actual))
+
+
+def benchmark_prefork(path="dataset/english_chapters/11-chapters/01.txt", method="dependency_tree",
+                      worker_counts=(1, 2, 4, 8), n_documents=32):
+    """
+    Compares analysing documents on threads of one process against analysing them on pools of pre-forked
+    workers of growing size, reporting the documents analysed per second and the memory of every worker.
+    The RSS of a worker counts the pages it shares with the other workers, its PSS only its share of them
+    :param path: str
+    :param method: str
+    :param worker_counts: tuple <int>
+    :param n_documents: int
+    :return: None
+    """
+    text = "".join(read_chunks(path))
+
+    def analyse(detect):
+        return list(detect(text, method, {}, result_mode="spans"))
+
+    for n_workers in worker_counts:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            start = time.perf_counter()
+            list(executor.map(lambda _: analyse(detect_text), range(n_documents)))
+            print("Threads:", n_workers, "documents/s:", n_documents / (time.perf_counter() - start))
+
+        pool = WorkerPool(n_workers)
+        pool.start()
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            start = time.perf_counter()
+            list(executor.map(lambda _: analyse(pool.detect_text), range(n_documents)))
+            print("Workers:", n_workers, "documents/s:", n_documents / (time.perf_counter() - start))
+        for worker in pool.health():
+            print("    Worker {pid}: RSS {rss_mb:.0f} MB, PSS {pss_mb:.0f} MB".format(
+                pid=worker["pid"], rss_mb=worker["rss"] / 2 ** 20, pss_mb=worker["pss"] / 2 ** 20))
+        print("    Parent RSS (MB):", resident_memory() / 2 ** 20)
+        pool.close()
+
+
+# benchmark_word_embedding(path="dataset/english_chapters/11-chapters/01.txt")
+# paragraphs, glove_dict = random_paragraphs(n_paragraphs=20, n_lemmas=300)
+# benchmark_word_embedding(paragraphs=paragraphs, glove_dict=glove_dict)
+# benchmark_pruned_glove_store(path="dataset/english_chapters/11-chapters/01.txt", reserve=20000)
+# benchmark_back_translation(path="dataset/english_chapters/11-chapters/01.txt", n_sentences=64)
+# benchmark_fast_back_translation(path="dataset/english_chapters/11-chapters/01.txt", n_sentences=64)
+# benchmark_bleu_kernel(path="dataset/english_chapters/11-chapters/01.txt", n_sentences=5000)
+# benchmark_batched_inference(path="dataset/english_chapters/54-chapters/095.txt", method="dependency_tree")
+# benchmark_prefork(path="dataset/english_chapters/11-chapters/01.txt", method="dependency_tree")
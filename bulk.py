@@ -0,0 +1,124 @@
+import json
+import tarfile
+import zipfile
+
+from segmentation import decode_text
+
+"""
+This file contains the bulk detection API of the web app. A batch of documents is sent either as JSON or as
+a zip or tar archive of text files, and the result of every document is sent back as one line of
+newline-delimited JSON (NDJSON) as soon as the document is analysed
+"""
+
+MAX_DOCUMENT_BYTES = 50 * 1024 * 1024  # Larger files of an archive are refused
+
+
+class BulkRequestError(Exception):
+    pass
+
+
+def json_documents(body):
+    """
+    Finds the documents of a JSON batch, {"documents": [{"name": "a.txt", "text": "..."}, ...]}. A document
+    can also be a bare string, named after its position in the batch
+    :param body: dict
+    :return: list <(str, str)>, name and text of each document
+    """
+    if not isinstance(body, dict) or not isinstance(body.get("documents"), list):
+        raise BulkRequestError('The batch must be a JSON object with a list of "documents"')
+
+    documents = []
+    for number, document in enumerate(body["documents"]):
+        if isinstance(document, str):
+            document = {"text": document}
+        if not isinstance(document, dict) or not isinstance(document.get("text"), str):
+            raise BulkRequestError("Document {} has no text".format(number))
+        # Decoded like an upload, so that both have the same line endings and cached results
+        documents.append((str(document.get("name", number)), decode_text(document["text"].encode("utf-8"))))
+    return documents
+
+
+def is_document(name):
+    """
+    Checks whether a file of an archive is a document, rather than a hidden file or metadata
+    :param name: str
+    :return: bool
+    """
+    return not any(part.startswith(".") or part == "__MACOSX" for part in name.split("/"))
+
+
+def read_document(archive, member):
+    """
+    Reads and decodes a file of a zip or tar archive. At most MAX_DOCUMENT_BYTES of it are read, since the size
+    recorded in the archive is not checked when the file is decompressed
+    :param archive: zipfile.ZipFile or tarfile.TarFile
+    :param member: zipfile.ZipInfo or tarfile.TarInfo
+    :return: (str, str), name and text of the document
+    """
+    if isinstance(archive, zipfile.ZipFile):
+        name, open_member = member.filename, archive.open
+    else:
+        name, open_member = member.name, archive.extractfile
+    try:
+        with open_member(member) as f:
+            data = f.read(MAX_DOCUMENT_BYTES + 1)
+    except (zipfile.BadZipFile, tarfile.TarError, EOFError):
+        raise BulkRequestError("{} could not be read from the archive".format(name))
+    if len(data) > MAX_DOCUMENT_BYTES:
+        raise BulkRequestError("{} is too large".format(name))
+    try:
+        return name, decode_text(data)
+    except UnicodeDecodeError:
+        raise BulkRequestError("{} is not a UTF-8 text file".format(name))
+
+
+def archive_documents(archive_file):
+    """
+    Finds the text files of a zip or tar archive (optionally compressed). The list of files is checked
+    at once, the files themselves are only read one at a time as they are analysed
+    :param archive_file: file object, seekable
+    :return: generator <(str, str)>, name and text of each document
+    """
+    try:
+        if zipfile.is_zipfile(archive_file):
+            archive = zipfile.ZipFile(archive_file)
+            members = [member for member in archive.infolist() if not member.is_dir() and is_document(member.filename)]
+            sizes = [(member.filename, member.file_size) for member in members]
+        else:
+            archive_file.seek(0)
+            archive = tarfile.open(fileobj=archive_file, mode="r:*")
+            members = [member for member in archive.getmembers() if member.isfile() and is_document(member.name)]
+            sizes = [(member.name, member.size) for member in members]
+    except (zipfile.BadZipFile, tarfile.TarError, EOFError):
+        raise BulkRequestError("The archive must be a zip or tar file")
+
+    for name, size in sizes:
+        if size > MAX_DOCUMENT_BYTES:
+            raise BulkRequestError("{} is too large".format(name))
+    return (read_document(archive, member) for member in members)
+
+
+def result_line(job):
+    """
+    Formats the result of a finished job as one NDJSON line
+    :param job: Job
+    :return: str
+    """
+    result = {
+        "id": job.id,
+        "name": job.filename,
+        "method": job.method,
+        "status": job.status,
+        "verdict": job.verdict,
+        "confidence": job.confidence,
+        "timings": {
+            "queued": round(job.started_at - job.created_at, 3),
+            "analysis": round(job.finished_at - job.started_at, 3),
+            "total": round(job.finished_at - job.created_at, 3),
+        },
+    }
+    if job.methods is not None:
+        result["methods"] = job.methods
+    if job.error is not None:
+        result["error"] = job.error
+    return json.dumps(result) + "\n"
@@ -0,0 +1,125 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+"""
+This file contains a persistent key-value cache stored in SQLite. It can be shared by several threads
+and processes, evicts the least recently used entries when it grows past its size cap, and can expire
+entries a given time after they were stored
+"""
+
+
+class SQLiteCache:
+    def __init__(self, path, max_entries=100000, ttl=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl  # Seconds an entry stays valid after it is stored, None to keep entries until evicted
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.local = threading.local()  # SQLite connections cannot be shared between threads
+
+    def connection(self):
+        """
+        Opens the connection of the current thread and process, creating the cache table if needed
+        :return: sqlite3.Connection
+        """
+        if getattr(self.local, "pid", None) != os.getpid():  # Connections must not be reused after a fork
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")  # Readers do not block the writer
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS cache "
+                               "(key TEXT PRIMARY KEY, value BLOB, last_access REAL, created REAL)")
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(cache)")]
+            if "created" not in columns:  # Caches written before entries could expire
+                connection.execute("ALTER TABLE cache ADD COLUMN created REAL DEFAULT 0")
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    def get_many(self, keys):
+        """
+        Looks up several keys at once
+        :param keys: list <str>
+        :return: dict <str, any>
+        """
+        found = {}
+        expired = []
+        now = time.time()
+        connection = self.connection()
+        for i in range(0, len(keys), 500):  # Stay below the SQLite limit on query parameters
+            batch = keys[i:i + 500]
+            rows = connection.execute("SELECT key, value, created FROM cache WHERE key IN ({})"
+                                      .format(",".join("?" * len(batch))), batch).fetchall()
+            for key, value, created in rows:
+                if self.ttl is not None and now - (created or 0) > self.ttl:
+                    expired.append(key)
+                else:
+                    found[key] = pickle.loads(value)
+
+        if expired:
+            connection.executemany("DELETE FROM cache WHERE key = ?", [(key,) for key in expired])
+        if found:
+            connection.executemany("UPDATE cache SET last_access = ? WHERE key = ?",
+                                   [(now, key) for key in found])
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def set_many(self, items):
+        """
+        Stores several values at once, evicting the least recently used entries if the cache is full
+        :param items: dict <str, any>
+        :return: None
+        """
+        now = time.time()
+        connection = self.connection()
+        connection.executemany("INSERT OR REPLACE INTO cache (key, value, last_access, created) VALUES (?, ?, ?, ?)",
+                               [(key, pickle.dumps(value), now, now) for key, value in items.items()])
+        self.writes += len(items)
+        if self.writes >= max(1, self.max_entries // 100):  # Counting the entries is slow, so check now and then
+            self.writes = 0
+            self.evict()
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def evict(self):
+        """
+        Deletes the expired entries, and the least recently used entries beyond max_entries
+        :return: None
+        """
+        connection = self.connection()
+        if self.ttl is not None:
+            connection.execute("DELETE FROM cache WHERE created < ?", (time.time() - self.ttl,))
+        excess = connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0] - self.max_entries
+        if excess > 0:
+            connection.execute("DELETE FROM cache WHERE key IN "
+                               "(SELECT key FROM cache ORDER BY last_access LIMIT ?)", (excess,))
+
+    def delete_prefix(self, prefix):
+        """
+        Deletes the entries whose key starts with prefix
+        :param prefix: str
+        :return: None
+        """
+        self.connection().execute("DELETE FROM cache WHERE substr(key, 1, ?) = ?", (len(prefix), prefix))
+
+    def clear(self):
+        self.connection().execute("DELETE FROM cache")
+
+    def stats(self):
+        """
+        Reports the hits and misses of this process and the number of entries in the cache
+        :return: dict
+        """
+        entries = self.connection().execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
@@ -1,25 +1,18 @@
-import spacy
+import itertools
+import threading
+import time
 
-from nltk import tokenize
+from annotation import nlp, pipe_units
+from collections import defaultdict
 from spacy.matcher import Matcher
 from spacy.util import filter_spans
 
 # This file contains functions that perform feature extraction for the dependency-tree method
 
-nlp = spacy.load("en_core_web_sm")
-
-
-def split_into_sentences(path):
-    """
-    Splits a given .txt file to a list of sentences.
-    :param path: str
-    :return: list <str>
-    """
-    with open(path, mode="r", encoding="utf-8") as f:
-        text = f.read()
-        text = text.replace("\n", " ")
-        sentences = tokenize.sent_tokenize(text)
-        return sentences
+VERB_PHRASE_PATTERN = [{'POS': 'VERB', 'OP': '?'},
+                       {'POS': 'ADV', 'OP': '*'},
+                       {'POS': 'AUX', 'OP': '*'},
+                       {'POS': 'VERB', 'OP': '+'}]
 
 
 def sentence_length(sentence):
@@ -31,63 +24,107 @@ def sentence_length(sentence):
     return len(sentence.split())
 
 
-def unnormalised_np_length(doc):
-    """
-    Finds the sum length of noun phrases in a sentence
-    :param doc: Doc
-    :return: int
-    """
-    np_length = 0
-    for x in doc.noun_chunks:
-        np_length += len(x.text.split())
-    return np_length
-
-
-def unnormalised_vp_length(doc):
-    """
-    Finds the sum length of verb phrases in a sentence
-    :param doc: Doc
-    :return: int
-    """
-    pattern = [{'POS': 'VERB', 'OP': '?'},
-               {'POS': 'ADV', 'OP': '*'},
-               {'POS': 'AUX', 'OP': '*'},
-               {'POS': 'VERB', 'OP': '+'}]
-
-    matcher = Matcher(nlp.vocab)
-    matcher.add("verb_phrase", [pattern])
-    matches = matcher(doc)
-    spans = [doc[start:end] for _, start, end in matches]
-
-    vp_length = 0
-    for word in filter_spans(spans):
-        vp_length += len(word)
-    return vp_length
-
-
-def max_tree_depth_helper(node, depth):
-    if node.n_lefts + node.n_rights > 0:
-        return max(max_tree_depth_helper(child, depth + 1) for child in node.children)
-    else:
+class DependencyTreeExtractor:
+    def __init__(self, vocab=nlp.vocab):
+        self.matcher = Matcher(vocab)  # Compiled once and reused for every sentence
+        self.matcher.add("verb_phrase", [VERB_PHRASE_PATTERN])
+        self.timings = defaultdict(float)  # Total seconds spent on each feature
+        self.sentences = 0
+        self.lock = threading.Lock()  # The extractor is shared by the threads analysing documents
+
+    def np_length(self, doc):
+        """
+        Finds the sum length of noun phrases in a sentence
+        :param doc: Doc
+        :return: int
+        """
+        return sum(len(chunk.text.split()) for chunk in doc.noun_chunks)
+
+    def vp_length(self, doc):
+        """
+        Finds the sum length of verb phrases in a sentence using the compiled matcher
+        :param doc: Doc
+        :return: int
+        """
+        spans = [doc[start:end] for _, start, end in self.matcher(doc)]
+        return sum(len(span) for span in filter_spans(spans))
+
+    @staticmethod
+    def tree_depth(doc):
+        """
+        Computes the max depth of the dependency tree of the first sentence,
+        walking the tree with an explicit stack instead of recursion, 0 for an empty doc
+        :param doc: Doc
+        :return: int
+        """
+        sentence = next(iter(doc.sents), None)
+        if sentence is None:
+            return 0
+        depth = 0
+        stack = [(sentence.root, 0)]
+        while stack:
+            node, node_depth = stack.pop()
+            depth = max(depth, node_depth)
+            stack.extend((child, node_depth + 1) for child in node.children)
         return depth
 
-
-def max_tree_depth(doc):
+    def timed(self, feature, function, doc):
+        start = time.perf_counter()
+        value = function(doc)
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.timings[feature] += elapsed
+        return value
+
+    def extract(self, sentence, doc):
+        """
+        Extracts the dependency-tree features of a sentence that has already been parsed
+        :param sentence: str
+        :param doc: Doc
+        :return: list <float>
+        """
+        s_length = sentence_length(sentence)
+        np_length = self.timed("np_length", self.np_length, doc)
+        vp_length = self.timed("vp_length", self.vp_length, doc)
+        depth = self.timed("tree_depth", self.tree_depth, doc)
+        with self.lock:
+            self.sentences += 1
+        return [s_length, np_length, vp_length, np_length / s_length, vp_length / s_length, depth]
+
+    def reset_timings(self):
+        with self.lock:
+            self.timings.clear()
+            self.sentences = 0
+
+
+extractor = DependencyTreeExtractor()
+
+
+def dependency_tree_features_from_doc(sentence, doc):
     """
-    Computes the max depth of a dependency tree for a sentence
+    Extracts the dependency-tree features of a sentence that has already been parsed
+    :param sentence: str
     :param doc: Doc
-    :return: int
+    :return: list <float>
     """
-    depth = [max_tree_depth_helper(sent.root, 0) for sent in doc.sents]
-    return depth[0]
+    return extractor.extract(sentence, doc)
 
 
 def dependency_tree_feature_extraction(sentence):
     doc = nlp(sentence)
-    s_length = sentence_length(sentence)
-    np_length = unnormalised_np_length(doc)
-    vp_length = unnormalised_vp_length(doc)
-    normalised_np_length = np_length / s_length
-    normalised_vp_length = vp_length / s_length
-    depth = max_tree_depth(doc)
-    return [s_length, np_length, vp_length, normalised_np_length, normalised_vp_length, depth]
+    return dependency_tree_features_from_doc(sentence, doc)
+
+
+def dependency_tree_feature_extraction_batch(sentences, batch_size=64, n_process=1, use_cache=False):
+    """
+    Performs feature extraction on many sentences, parsing them in batches on n_process processes.
+    The features of each sentence are yielded in the order of the sentences
+    :param sentences: iterable <str>
+    :param batch_size: int
+    :param n_process: int
+    :param use_cache: bool
+    :return: generator <list<float>>
+    """
+    sentences, texts = itertools.tee(sentences)
+    for sentence, doc in zip(sentences, pipe_units(texts, batch_size, n_process, use_cache)):
+        yield dependency_tree_features_from_doc(sentence, doc)
@@ -0,0 +1,84 @@
+import os
+
+import numpy as np
+
+from functools import lru_cache
+
+"""
+This file contains a store for word embeddings that is memory-mapped from disk,
+so that every process on a machine shares the same copy of the vectors
+"""
+
+GLOVE_STORE = "word_embedding/gloVe/gloVe.6B.50d"
+PRUNED_GLOVE_STORE = "word_embedding/gloVe/gloVe.6B.50d.pruned"
+
+
+class EmbeddingStore:
+    def __init__(self, path):
+        self.path = path
+        self.matrix = np.load(path + ".npy", mmap_mode="r")  # Read-only pages shared through the OS page cache
+        self.index = self.read_index()
+
+    def read_index(self):
+        """
+        Read the word of each row of the matrix
+        :return: dict <str, int>
+        """
+        with open(self.path + ".vocab", mode="r", encoding="utf-8") as f:
+            return {word.rstrip("\n"): row for row, word in enumerate(f)}
+
+    def get(self, word, default=None):
+        """
+        Find the embedding of a word, behaving like dict.get
+        :param word: str
+        :param default: any
+        :return: numpy.ndarray <float> or NoneType
+        """
+        row = self.index.get(word)
+        if row is None:
+            return default
+        return self.matrix[row]
+
+    def __contains__(self, word):
+        return word in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+
+def write_embedding_store(words, vectors, path=GLOVE_STORE, dtype="float32"):
+    """
+    Writes word embeddings to a matrix file and a word index file that can be memory-mapped
+    :param words: list <str>
+    :param vectors: list <numpy.ndarray<float>>
+    :param path: str
+    :param dtype: str
+    :return: None
+    """
+    matrix = np.array(vectors, dtype=dtype)
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    # Write to temporary files first so that readers never see a half-written store
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    np.save(tmp_path + ".npy", matrix)
+    with open(tmp_path + ".vocab", mode="w", encoding="utf-8") as f:
+        for word in words:
+            f.write(word + "\n")
+    os.replace(tmp_path + ".npy", path + ".npy")
+    os.replace(tmp_path + ".vocab", path + ".vocab")
+
+
+def store_exists(path=GLOVE_STORE):
+    return os.path.isfile(path + ".npy") and os.path.isfile(path + ".vocab")
+
+
+@lru_cache(maxsize=None)
+def load_embedding_store(path=GLOVE_STORE):
+    """
+    Loads an embedding store once per process
+    :param path: str
+    :return: EmbeddingStore
+    """
+    return EmbeddingStore(path)
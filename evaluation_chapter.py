@@ -1,9 +1,12 @@
 import os
 import pandas
 
+from annotation import pipe_lemmas_and_tags
 from collections import Counter
-from dependency_tree import dependency_tree_feature_extraction, split_into_sentences
-from word_embedding import split_into_paragraphs, lemmatise, word_embedding_feature_extraction
+from dependency_tree import dependency_tree_feature_extraction_batch
+from embedding_store import GLOVE_STORE, PRUNED_GLOVE_STORE
+from segmentation import split_into_paragraphs, split_into_sentences
+from word_embedding import get_glove_store, word_embedding_feature_extraction
 from word_distribution import word_distribution_feature_extraction
 from util import load_model
 
@@ -16,13 +19,9 @@ wd_model = load_model("word_distribution/wd_classifier.pickle")
 we_model = load_model("word_embedding/we_classifier.pickle")
 
 
-def dependency_tree(path, save_file):
-    sentences = split_into_sentences(path)
-    features_list = []
-    for s in sentences:
-        if len(s.split()) > 5:
-            features = dependency_tree_feature_extraction(s)
-            features_list.append(features)
+def dependency_tree(path, save_file, n_process=1):
+    sentences = [s for s in split_into_sentences(path) if len(s.split()) > 5]
+    features_list = list(dependency_tree_feature_extraction_batch(sentences, n_process=n_process, use_cache=True))
 
     df = pandas.DataFrame(features_list)
     predictions = dt_model.predict(df)
@@ -33,7 +32,7 @@ def dependency_tree(path, save_file):
 
 
 def word_distribution(path, save_file):
-    features = [word_distribution_feature_extraction(path)]
+    features = [word_distribution_feature_extraction(path, use_cache=True)]
     df = pandas.DataFrame(features)
     result = wd_model.predict(df)[0]
 
@@ -41,13 +40,14 @@ def word_distribution(path, save_file):
         f.write(result + "\n")
 
 
-def word_embedding(path, save_file):
+def word_embedding(path, save_file, pruned_glove=False):
+    # The pruned GloVe store only has the words of the corpus, so it is only used on the corpus
+    glove_dict = get_glove_store(PRUNED_GLOVE_STORE if pruned_glove else GLOVE_STORE)
     paragraphs = split_into_paragraphs(path)
     features_list = []
-    for p in paragraphs:
-        lemmas = lemmatise(p)
+    for lemmas, _ in pipe_lemmas_and_tags(paragraphs, use_cache=True):
         if len(lemmas) > 50:
-            means, variances = word_embedding_feature_extraction(lemmas)
+            means, variances = word_embedding_feature_extraction(lemmas, glove_dict)
             features = means + variances
             if len(features) == 1332:
                 features_list.append(features)
@@ -60,16 +60,16 @@ def word_embedding(path, save_file):
         f.write(result + "\n")
 
 
-def batch_evaluate_chapter(method, root, save_file):
+def batch_evaluate_chapter(method, root, save_file, n_process=1, pruned_glove=False):
     for chapter in os.scandir(root):
         for file in os.scandir(chapter.path):
             print(file.path)
             if method == "dependency_tree":
-                dependency_tree(file.path, save_file)
+                dependency_tree(file.path, save_file, n_process)
             elif method == "word_distribution":
                 word_distribution(file.path, save_file)
             elif method == "word_embedding":
-                word_embedding(file.path, save_file)
+                word_embedding(file.path, save_file, pruned_glove)
 
 
 batch_evaluate_chapter(root="./dataset/mt_german_chapters", method="dependency_tree",
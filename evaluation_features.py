@@ -1,9 +1,12 @@
 import os
 import pandas
 
-from back_translation import back_translate, back_translation_feature_extraction
-from dependency_tree import dependency_tree_feature_extraction, split_into_sentences
-from word_embedding import split_into_paragraphs, lemmatise, word_embedding_feature_extraction
+from annotation import pipe_lemmas_and_tags
+from back_translation import back_translate_batch, back_translation_feature_extraction_batch
+from dependency_tree import dependency_tree_feature_extraction_batch
+from embedding_store import GLOVE_STORE, PRUNED_GLOVE_STORE
+from segmentation import split_into_paragraphs, split_into_sentences
+from word_embedding import get_glove_store, word_embedding_feature_extraction
 from word_distribution import word_distribution_feature_extraction
 from util import load_model
 
@@ -18,13 +21,8 @@ we_model = load_model("word_embedding/we_classifier.pickle")
 
 
 def back_translation(path, save_file):
-    sentences = split_into_sentences(path)
-    features_list = []
-    for s in sentences:
-        if len(s.split()) > 5:
-            bt_s = back_translate(s)
-            features = back_translation_feature_extraction(source_text=s, back_translation=bt_s)
-            features_list.append(features)
+    sentences = [s for s in split_into_sentences(path) if len(s.split()) > 5]
+    features_list = back_translation_feature_extraction_batch(sentences, back_translate_batch(sentences))
 
     df = pandas.DataFrame(features_list)
     predictions = bt_model.predict(df)
@@ -35,13 +33,9 @@ def back_translation(path, save_file):
             f.write(item + "\n")
 
 
-def dependency_tree(path, save_file):
-    sentences = split_into_sentences(path)
-    features_list = []
-    for s in sentences:
-        if len(s.split()) > 5:
-            features = dependency_tree_feature_extraction(s)
-            features_list.append(features)
+def dependency_tree(path, save_file, n_process=1):
+    sentences = [s for s in split_into_sentences(path) if len(s.split()) > 5]
+    features_list = list(dependency_tree_feature_extraction_batch(sentences, n_process=n_process, use_cache=True))
     df = pandas.DataFrame(features_list)  # Load the feature_level as a dataframe
     predictions = dt_model.predict(df)  # Use the model to predict whether each paragraph is machine-translated
     result = list(predictions)
@@ -52,7 +46,7 @@ def dependency_tree(path, save_file):
 
 
 def word_distribution(path, save_file):
-    features = word_distribution_feature_extraction(path)
+    features = word_distribution_feature_extraction(path, use_cache=True)
     df = pandas.DataFrame([features])
     result = wd_model.predict(df)[0]
 
@@ -60,13 +54,14 @@ def word_distribution(path, save_file):
         f.write(result + "\n")
 
 
-def word_embedding(path, save_file):
+def word_embedding(path, save_file, pruned_glove=False):
+    # The pruned GloVe store only has the words of the corpus, so it is only used on the corpus
+    glove_dict = get_glove_store(PRUNED_GLOVE_STORE if pruned_glove else GLOVE_STORE)
     paragraphs = split_into_paragraphs(path)
     features_list = []
-    for p in paragraphs:
-        lemmas = lemmatise(p)
+    for lemmas, _ in pipe_lemmas_and_tags(paragraphs, use_cache=True):
         if len(lemmas) > 50:
-            features = word_embedding_feature_extraction(lemmas)
+            features = word_embedding_feature_extraction(lemmas, glove_dict)
             mean_list = features[0]
             variance_list = features[1]
             features = mean_list + variance_list
@@ -82,16 +77,16 @@ def word_embedding(path, save_file):
             f.write(item + "\n")
 
 
-def batch_evaluate_feature(method, root, save_file):
+def batch_evaluate_feature(method, root, save_file, n_process=1, pruned_glove=False):
     for chapter in os.scandir(root):
         for file in os.scandir(chapter.path):
             print(file.path)
             if method == "dependency_tree":
-                dependency_tree(file.path, save_file)
+                dependency_tree(file.path, save_file, n_process)
             elif method == "word_distribution":
                 word_distribution(file.path, save_file)
             elif method == "word_embedding":
-                word_embedding(file.path, save_file)
+                word_embedding(file.path, save_file, pruned_glove)
 
 
 # batch_evaluate_feature(method="dependency_tree", root="./dataset/mt_german_chapters",
@@ -1,10 +1,77 @@
+import bisect
 import fitz
 import textwrap
 
 from fpdf import FPDF
 
+MM_TO_PT = 72 / 25.4
+WHITESPACE_TO_SPACE = {ord(c): ' ' for c in '\t\n\x0b\x0c\r '}  # The whitespace that textwrap turns into spaces
 
-def txt_to_pdf(text, filename):
+
+class TextLayout:
+    # Where txt_to_pdf placed every character of the text: one record per wrapped line, in text order
+
+    def __init__(self):
+        self.starts = []
+        self.lines = []
+
+    def add(self, start, end, page, x, y, height, char_width, columns=None):
+        # start and end are offsets in the text, columns the offset of each printed character when tabs were expanded
+        self.starts.append(start)
+        self.lines.append((start, end, page, x, y, height, char_width, columns))
+
+    def rects(self, start, end):
+        # Finds the rectangles, in points, covering the characters from start to end, grouped by page (from 0)
+        rects = {}
+        i = max(0, bisect.bisect_right(self.starts, start) - 1)
+        while i < len(self.lines) and self.lines[i][0] < end:
+            line_start, line_end, page, x, y, height, char_width, columns = self.lines[i]
+            i += 1
+            a = max(start, line_start) - line_start
+            b = min(end, line_end) - line_start
+            if a >= b:
+                continue
+            if columns is not None:
+                a = bisect.bisect_left(columns, a)
+                b = bisect.bisect_left(columns, b)
+            rect = fitz.Rect(x + a * char_width, y, x + b * char_width, y + height) * MM_TO_PT
+            rects.setdefault(page, []).append(rect)
+        return rects
+
+
+def expand_tabs(line):
+    # Expands tabs like textwrap does, returning the expanded line and the offset in line of each of its characters
+    expanded = []
+    columns = []
+    for i, c in enumerate(line):
+        n = 8 - len(columns) % 8 if c == '\t' else 1
+        expanded.append(' ' * n if c == '\t' else c)
+        columns.extend([i] * n)
+    return ''.join(expanded), columns
+
+
+def wrapped_offsets(line, wrapped):
+    # Finds where each line wrapped by textwrap starts and ends in the original line. Wrapping only drops
+    # whitespace at the line breaks and turns the other whitespace into spaces, so each wrapped line
+    # is found in the original line with its whitespace turned into spaces
+    columns = None
+    if '\t' in line:
+        line, columns = expand_tabs(line)
+    line = line.translate(WHITESPACE_TO_SPACE)
+    position = 0
+    for w in wrapped:
+        start = line.index(w, position)
+        position = start + len(w)
+        if columns is None:
+            yield start, position, None
+        else:
+            line_columns = [columns[j] - columns[start] for j in range(start, position)]
+            yield columns[start], columns[position - 1] + 1, line_columns
+
+
+def txt_to_pdf(text, filename=None, layout=None):
+    # Without filename the PDF is returned as bytes instead of written to disk.
+    # With a TextLayout, the position of every character on the pages is recorded in it
     text = text.encode('latin-1', 'replace').decode('latin-1')
     a4_width_mm = 210
     pt_to_mm = 0.35
@@ -12,24 +79,42 @@ def txt_to_pdf(text, filename):
     fontsize_mm = fontsize_pt * pt_to_mm
     margin_bottom_mm = 10
     character_width_mm = 7 * pt_to_mm
-    width_text = a4_width_mm / character_width_mm
+    width_text = int(a4_width_mm / character_width_mm)  # textwrap cannot split long words at a fractional width
 
     pdf = FPDF(orientation='P', unit='mm', format='A4')
     pdf.set_auto_page_break(True, margin=margin_bottom_mm)
     pdf.add_page()
     pdf.set_font(family='Courier', size=fontsize_pt)
     splitted = text.split('\n')
+    char_width_mm = pdf.get_string_width(' ')
 
+    offset = 0
     for line in splitted:
         lines = textwrap.wrap(line, width_text)
         if len(lines) == 0:
             pdf.ln()
-        for wrap in lines:
-            pdf.cell(0, fontsize_mm, wrap, ln=1)
+        if layout is None:
+            for wrap in lines:
+                pdf.cell(0, fontsize_mm, wrap, ln=1)
+        else:
+            for wrap, (start, end, columns) in zip(lines, wrapped_offsets(line, lines)):
+                pdf.cell(0, fontsize_mm, wrap, ln=1)
+                # The cell may have moved to a new page, so read its position after drawing it
+                layout.add(offset + start, offset + end, pdf.page - 1, pdf.l_margin + pdf.c_margin,
+                           pdf.get_y() - fontsize_mm, fontsize_mm, char_width_mm, columns)
+        offset += len(line) + 1
+    if filename is None:
+        data = pdf.output(dest='S')
+        if isinstance(data, str):  # PyFPDF returns the document as a latin-1 string, fpdf2 as a bytearray
+            data = data.encode('latin-1')
+        return bytes(data)
     pdf.output(filename, 'F')
 
 
 def open_pdf(input_pdf):
+    # A PDF held in memory is given as bytes, otherwise as a path
+    if isinstance(input_pdf, (bytes, bytearray)):
+        return fitz.open(stream=input_pdf, filetype="pdf")
     return fitz.open(input_pdf)
 
 
@@ -42,5 +127,23 @@ def highlight_pdf(document, phrase):
     return document
 
 
-def save_pdf(document, output_pdf):
+def highlight_spans(document, layout, spans):
+    # Highlights the text between the (start, end) offsets of each span in one pass over the pages,
+    # reading the position of the text from the layout recorded by txt_to_pdf instead of searching for it
+    annotations = {}
+    for start, end in spans:
+        for page, rects in layout.rects(start, end).items():
+            annotations.setdefault(page, []).append(rects)
+    for page_number, span_rects in annotations.items():
+        page = document[page_number]
+        for rects in span_rects:
+            highlight = page.add_highlight_annot(rects)
+            highlight.update()
+    return document
+
+
+def save_pdf(document, output_pdf=None):
+    # Without output_pdf the document is returned as bytes instead of written to disk
+    if output_pdf is None:
+        return document.tobytes(garbage=4, deflate=True, clean=True)
     document.save(output_pdf, garbage=4, deflate=True, clean=True)
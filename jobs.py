@@ -0,0 +1,308 @@
+import os
+import shutil
+import sys
+import threading
+import time
+import traceback
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+from main import detect_text, render_pdf
+
+"""
+This file contains the background jobs of the web app. Every uploaded document is analysed by a job on a
+bounded pool of worker threads. The uploaded text and the result are kept in memory, and the result is only
+saved to its own directory if requested. In "spans" result mode the browser highlights the text itself and
+the PDF is only rendered when it is downloaded. The events of a job are kept so that any number
+of clients can follow it, and a client that disconnects can reattach to it later
+"""
+
+RESULTS_DIR = "static/results"
+BATCH_RESULT_BYTES = 256 * 1024 ** 2  # Memory held by the texts and PDFs of finished jobs of the bulk API
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, job_id, method, filename, text, result_dir=None, result_mode="pdf", batch=False):
+        self.id = job_id
+        self.method = method
+        self.filename = filename
+        self.batch = batch  # Created by the bulk API, kept within its own budget of finished jobs
+        self.text = text  # Dropped once the job has run in "pdf" result mode, or beyond the budget of the bulk API
+        self.result_dir = result_dir  # Only set if the result is saved to disk
+        self.result_mode = result_mode
+        self.spans = None  # Start and end offsets and prediction of every classified span
+        self.pdf = None
+        self.status = "queued"
+        self.events = []  # Every SSE message of the job so far, the index of a message is its event ID
+        self.condition = threading.Condition()
+        self.verdict = None
+        self.confidence = None
+        self.methods = None  # Result of every method of the "all" method
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def publish(self, event):
+        with self.condition:
+            self.events.append(event)
+            self.condition.notify_all()
+
+    def finish(self, status):
+        with self.condition:
+            self.status = status
+            self.finished_at = time.time()
+            self.condition.notify_all()
+
+    def is_finished(self):
+        return self.status in ("done", "failed")
+
+    def result_bytes(self):
+        """
+        Finds the memory held by the text and the PDF of the job
+        :return: int
+        """
+        size = sys.getsizeof(self.text) if self.text is not None else 0
+        return size + (len(self.pdf) if self.pdf is not None else 0)
+
+    def result_path(self):
+        if self.result_dir is None:
+            return None
+        return os.path.join(self.result_dir, "result.pdf")
+
+    def subscribe(self, last_event_id=None, keepalive=15.0):
+        """
+        Follows the events of the job as SSE messages, starting after last_event_id so that a client
+        reattaching to the job does not receive the same events twice
+        :param last_event_id: str or NoneType
+        :param keepalive: float
+        :return: generator <str>
+        """
+        position = 0
+        if last_event_id is not None and last_event_id.isdigit():
+            position = int(last_event_id) + 1
+
+        while True:
+            with self.condition:
+                if position >= len(self.events) and not self.is_finished():
+                    self.condition.wait(timeout=keepalive)
+                events = self.events[position:]
+                finished = self.is_finished()
+
+            if not events and not finished:
+                yield ": keepalive\n\n"  # Lets the server notice clients that went away
+            for event in events:
+                yield "id: {}\n{}".format(position, event)
+                position += 1
+            if finished and position >= len(self.events):
+                return
+
+
+class JobManager:
+    def __init__(self, max_workers=2, max_queued=16, keep_seconds=3600, max_finished=100, max_batch_finished=1000,
+                 max_batch_bytes=BATCH_RESULT_BYTES, persist_results=False, results_dir=RESULTS_DIR, result_mode="pdf",
+                 cache=None, workers=None):
+        self.max_workers = max_workers
+        self.max_queued = max_queued  # Jobs waiting for a worker beyond those being run
+        self.keep_seconds = keep_seconds  # How long a finished job and its result are kept
+        self.max_finished = max_finished  # Most finished jobs kept, since their results are held in memory
+        self.max_batch_finished = max_batch_finished  # Most finished jobs of the bulk API kept, on top of those
+        # Most bytes of text and PDF kept by the finished jobs of the bulk API, whose PDF is rendered on download
+        self.max_batch_bytes = max_batch_bytes
+        self.persist_results = persist_results  # Also save every result to its own directory
+        self.results_dir = results_dir
+        self.result_mode = result_mode  # "pdf" to render every result, "spans" to render them on download
+        self.cache = cache  # ResultCache of the results of documents analysed before, or None
+        self.workers = workers  # WorkerPool of pre-forked processes analysing the documents, or None to use threads
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="detect")
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.job_finished = threading.Condition()  # Notified every time a job finishes
+
+    def pending(self):
+        """
+        Counts the jobs that are queued or running
+        :return: int
+        """
+        with self.lock:
+            return sum(1 for job in self.jobs.values() if not job.is_finished())
+
+    def is_full(self):
+        return self.pending() >= self.max_workers + self.max_queued
+
+    def create(self, filename, method, text, result_mode=None, batch=False):
+        """
+        Creates a job for an uploaded text
+        :param filename: str
+        :param method: str
+        :param text: str
+        :param result_mode: str or NoneType, result mode of the manager if None
+        :param batch: bool, whether the job is part of a batch of the bulk API
+        :return: Job
+        """
+        self.remove_expired()
+        with self.lock:
+            pending = sum(1 for job in self.jobs.values() if not job.is_finished())
+            if pending >= self.max_workers + self.max_queued:
+                raise JobQueueFull("{} documents are already being analysed".format(pending))
+
+            job_id = uuid.uuid4().hex
+            result_dir = os.path.join(self.results_dir, job_id) if self.persist_results else None
+            job = Job(job_id, method, filename, text, result_dir, result_mode or self.result_mode, batch)
+            self.jobs[job_id] = job
+        if job.result_dir is not None:
+            os.makedirs(job.result_dir, exist_ok=True)
+        return job
+
+    def start(self, job):
+        return self.executor.submit(self.run, job)
+
+    def run(self, job):
+        """
+        Runs the detection of a job, publishing its events as they are produced
+        :param job: Job
+        :return: None
+        """
+        job.status = "running"
+        job.started_at = time.time()
+        status = "done"
+        output = {}
+        try:
+            detect = detect_text if self.workers is None else self.workers.detect_text
+            events = detect(job.text, job.method, output, save_path=job.result_path(),
+                            result_mode=job.result_mode, cache=self.cache)
+            for event in events:
+                job.pdf = output.get("pdf")  # Set before the final result is published
+                job.spans = output.get("spans")
+                job.publish(event)
+            job.verdict = output.get("verdict")
+            job.confidence = output.get("confidence")
+            job.methods = output.get("methods")
+        except Exception as e:
+            traceback.print_exc()
+            job.error = type(e).__name__
+            job.publish("data: {}\n\n".format("error," + type(e).__name__))
+            status = "failed"
+        finally:
+            if job.result_mode == "pdf" or status == "failed":
+                job.text = None
+        with self.job_finished:
+            job.finish(status)
+            self.job_finished.notify_all()
+        if job.batch:
+            self.trim_batch_results()
+
+    def run_batch(self, documents, method, max_in_flight=None, keepalive=15.0):
+        """
+        Analyses a batch of documents, yielding every job as soon as it finishes. At most max_in_flight
+        documents of the batch are queued at once, and a document only enters the queue when there is room
+        for it, so that a large batch waits for the workers instead of filling the queue for the other users.
+        While no job of the batch finishes for keepalive seconds, None is yielded so that the client can be sent
+        a line. The documents are only read as they enter the queue, an error reading them is raised once
+        the documents read before it are analysed
+        :param documents: iterable <(str, str)>, name and text of each document
+        :param method: str
+        :param max_in_flight: int or NoneType, twice the number of workers if None
+        :param keepalive: float
+        :return: generator <Job or NoneType>
+        """
+        if max_in_flight is None:
+            max_in_flight = 2 * self.max_workers
+        in_flight = []  # Jobs of the batch that are queued or running
+        error = None
+        last_yield = time.monotonic()
+        documents = iter(documents)
+        document = next(documents, None)
+        while document is not None or in_flight:
+            while document is not None and len(in_flight) < max_in_flight:
+                try:
+                    # The spans of every document can be asked for, its PDF is only rendered if it is downloaded
+                    job = self.create(document[0], method, document[1], result_mode="spans", batch=True)
+                except JobQueueFull:
+                    break  # The queue is full of the jobs of other users, until one of them finishes
+                self.start(job)
+                in_flight.append(job)
+                try:
+                    document = next(documents, None)
+                except Exception as e:
+                    error = e  # The documents already queued are still reported before the error
+                    document = None
+
+            with self.job_finished:
+                finished = [job for job in in_flight if job.is_finished()]
+                if not finished:
+                    self.job_finished.wait(timeout=max(0.0, last_yield + keepalive - time.monotonic()))
+            if not finished:
+                if time.monotonic() - last_yield >= keepalive:
+                    last_yield = time.monotonic()
+                    yield None
+                continue
+            for job in sorted(finished, key=lambda job: job.finished_at):
+                in_flight.remove(job)
+                last_yield = time.monotonic()
+                yield job
+        if error is not None:
+            raise error
+
+    def result_pdf(self, job):
+        """
+        Finds the highlighted document of a job, rendering it the first time it is asked for in "spans" mode
+        :param job: Job
+        :return: bytes or NoneType
+        """
+        with job.condition:
+            if job.pdf is None and job.spans is not None and job.text is not None:
+                job.pdf = render_pdf(job.text, job.spans)
+                if job.result_dir is not None:
+                    with open(job.result_path(), mode="wb") as f:
+                        f.write(job.pdf)
+            pdf = job.pdf
+        if job.batch:
+            self.trim_batch_results()
+        return pdf
+
+    def trim_batch_results(self):
+        """
+        Drops the text and the PDF of the oldest finished jobs of the bulk API beyond max_batch_bytes, so that
+        a large batch does not keep every document in memory. Their verdict and spans are kept, but their PDF
+        can no longer be downloaded
+        :return: None
+        """
+        with self.lock:
+            finished = sorted((job for job in self.jobs.values() if job.batch and job.is_finished()),
+                              key=lambda job: job.finished_at, reverse=True)
+            kept = 0
+            for job in finished:
+                with job.condition:
+                    kept += job.result_bytes()
+                    if kept > self.max_batch_bytes:
+                        job.text = None
+                        job.pdf = None
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def remove_expired(self):
+        """
+        Forgets the jobs that finished more than keep_seconds ago, or the oldest ones beyond max_finished
+        (max_batch_finished for the jobs of the bulk API), and deletes their results
+        :return: None
+        """
+        now = time.time()
+        with self.lock:
+            finished = sorted((job for job in self.jobs.values() if job.is_finished()), key=lambda job: job.finished_at)
+            expired = []
+            for batch, max_finished in ((False, self.max_finished), (True, self.max_batch_finished)):
+                jobs = [job for job in finished if job.batch == batch]
+                oldest = max(0, len(jobs) - max_finished)
+                expired += jobs[:oldest] + [job for job in jobs[oldest:] if now - job.finished_at > self.keep_seconds]
+            for job in expired:
+                del self.jobs[job.id]
+        for job in expired:
+            if job.result_dir is not None:
+                shutil.rmtree(job.result_dir, ignore_errors=True)
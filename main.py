@@ -1,119 +1,497 @@
+import itertools
+import json
+import multiprocessing
 import os
-import pandas
-import pickle
+import threading
+import time
+
+import numpy as np
 
 from collections import Counter
-from dependency_tree import dependency_tree_feature_extraction, split_into_sentences
-from highlighter import open_pdf, highlight_pdf, save_pdf, txt_to_pdf
-from word_embedding import split_into_paragraphs, lemmatise, word_embedding_feature_extraction
-from word_distribution import word_distribution_feature_extraction
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from dependency_tree import dependency_tree_feature_extraction_batch
+from highlighter import open_pdf, highlight_spans, save_pdf, txt_to_pdf, TextLayout
+from model_registry import classifiers
+from segmentation import iter_paragraph_spans, iter_sentence_spans
+from word_embedding import lemmatise, word_embedding_feature_extraction, N_FEATURES
+from word_distribution import word_distribution_feature_extraction_from_text
 
+PREDICT_CHUNK_SIZE = 256  # Feature rows classified by one call to the classifier
+PROGRESS_EVENTS_PER_SECOND = 4  # Most progress and partial result events sent to the browser per second
+METHODS = ("dependency_tree", "word_embedding", "word_distribution")  # Combined by the "all" method
 
-def load_model(path):
-    with open(path, "rb") as target:
-        model = pickle.load(target)
-    return model
+ENSEMBLE_DOCUMENTS = 2  # Most documents analysed at once by the process pool of the "all" method
+ENSEMBLE_PROCESSES = len(METHODS)  # Processes of the pool of the "all" method, one per method
 
+ensemble_executor = None  # Process pool of the "all" method, see start_ensemble_pool
+ensemble_lock = threading.Lock()
+ensemble_slots = threading.BoundedSemaphore(ENSEMBLE_DOCUMENTS)
 
-def detect(file, method):
-    txt_path = os.path.join("./static/uploaded_file", file)
-    pdf_path = os.path.join("./static/results", os.path.splitext(file)[0] + ".pdf")
-    highlighted_pdf_path = "./static/results/result.pdf"
 
-    if os.path.isfile(highlighted_pdf_path):
-        os.remove(highlighted_pdf_path)
+class NoUnitsError(ValueError):
+    pass  # The text has no sentence or paragraph long enough for the method
 
-    with open(txt_path, mode="r", encoding="utf-8-sig") as f:
-        text = f.read()
-        txt_to_pdf(text, pdf_path)
 
-    if method == "dependency_tree":
+def predict_in_chunks(model, items, chunk_size=PREDICT_CHUNK_SIZE, max_delay=None):
+    """
+    Classifies a stream of (text, features) pairs, collecting the feature rows into one array per chunk
+    so that the classifier is called once per chunk instead of once per row. With max_delay, a chunk is
+    also classified once its first row has waited that many seconds, so that slow streams still report results
+    :param model: sklearn classifier
+    :param items: iterable <(str, list<float>)>
+    :param chunk_size: int
+    :param max_delay: float or NoneType
+    :return: generator <(str, str)>
+    """
+    texts = []
+    rows = []
+    first_row_time = 0.0
+    for text, features in items:
+        if not rows:
+            first_row_time = time.monotonic()
+        texts.append(text)
+        rows.append(features)
+        if len(rows) == chunk_size or (max_delay is not None and time.monotonic() - first_row_time >= max_delay):
+            yield from zip(texts, model.predict(np.array(rows, dtype=float)))
+            texts = []
+            rows = []
+    if rows:
+        yield from zip(texts, model.predict(np.array(rows, dtype=float)))
+
+
+def sse(data, event=None):
+    """
+    Formats a server-sent event, unnamed events are received by EventSource.onmessage
+    :param data: str
+    :param event: str or NoneType
+    :return: str
+    """
+    if event is None:
+        return 'data: {}\n\n'.format(data)
+    return 'event: {}\ndata: {}\n\n'.format(event, data)
+
+
+class ProgressReporter:
+    def __init__(self, total_characters, start=10, end=80, max_rate=PROGRESS_EVENTS_PER_SECOND):
+        self.total_characters = max(1, total_characters)
+        self.start = start  # Progress when the extraction starts and ends, in percent
+        self.end = end
+        self.min_interval = 1.0 / max_rate
+        self.last_event_time = 0.0
+        self.last_progress = start
+        self.predictions = Counter()
+        self.processed = 0
+        self.flagged = 0
+        self.new_flagged = []  # Indices of the units flagged since the last partial result
+
+    def add(self, prediction, characters):
+        """
+        Records the prediction of the next unit, returning the events to send if enough time has passed
+        :param prediction: str
+        :param characters: int, characters of the document analysed so far
+        :return: list <str>
+        """
+        if prediction == "machine-translated":
+            self.new_flagged.append(self.processed)
+            self.flagged += 1
+        self.predictions[prediction] += 1
+        self.processed += 1
+        if time.monotonic() - self.last_event_time < self.min_interval:
+            return []
+        return self.events(characters)
+
+    def events(self, characters):
+        """
+        Reports the progress and the partial result: majority verdict so far, running confidence
+        and the indices of the newly flagged units
+        :param characters: int
+        :return: list <str>
+        """
+        self.last_event_time = time.monotonic()
+        events = []
+        progress = round(self.start + (self.end - self.start) * min(1.0, characters / self.total_characters))
+        if progress > self.last_progress:
+            self.last_progress = progress
+            events.append(sse(progress))
+        if self.processed:
+            partial = {
+                "verdict": self.predictions.most_common(1)[0][0],
+                "confidence": round(self.flagged / self.processed * 100),
+                "processed": self.processed,
+                "flagged": self.new_flagged,
+            }
+            self.new_flagged = []
+            events.append(sse(json.dumps(partial), event="partial"))
+        return events
+
+
+def word_embedding_rows(spans):
+    """
+    Finds the word-embedding feature row of every paragraph with more than 50 words. The lemmas are tagged
+    by nltk as when the classifier was trained, and paragraphs with tags outside POS_TAGS are left out
+    since their rows are longer than the rows the classifier was trained on
+    :param spans: iterable <(int, int, str)>, start and end offsets of each paragraph and the paragraph
+    :return: generator <((int, int, str), list<float>)>
+    """
+    for span in spans:
+        lemmas = lemmatise(span[2])
+        if len(lemmas) > 50:
+            means, variances = word_embedding_feature_extraction(lemmas)
+            if len(means) + len(variances) == N_FEATURES:
+                yield span, means + variances
+
+
+def render_pdf(text, spans):
+    """
+    Lays out a text in a PDF and highlights the spans predicted as machine-translated
+    :param text: str
+    :param spans: list <(int, int, str)>, start and end offsets and prediction of each span
+    :return: bytes
+    """
+    layout = TextLayout()  # Where each character of the text is drawn, to highlight spans without searching
+    doc = open_pdf(txt_to_pdf(text, layout=layout))
+    flagged = [(start, end) for start, end, prediction in spans if prediction == "machine-translated"]
+    pdf = save_pdf(highlight_spans(doc, layout, flagged))
+    doc.close()
+    return pdf
+
+
+def finish_result(text, spans, result_mode="pdf", output=None, save_path=None):
+    """
+    Produces the result of a detection. In "pdf" mode the highlighted document is rendered, kept as bytes
+    in output["pdf"] and written to save_path if given. In "spans" mode no PDF is rendered, the spans are sent
+    as an SSE event instead so that the browser can highlight the text itself
+    :param text: str
+    :param spans: list <(int, int, str)>
+    :param result_mode: str
+    :param output: dict or NoneType
+    :param save_path: str or NoneType
+    :return: generator <str>
+    """
+    if output is not None:
+        output["spans"] = spans
+    if result_mode == "spans":
+        yield sse(json.dumps({"spans": spans}), event="spans")
+        return
+
+    pdf = render_pdf(text, spans)
+    if output is not None:
+        output["pdf"] = pdf
+    if save_path is not None:
+        with open(save_path, mode="wb") as f:
+            f.write(pdf)
+
+
+def detect_text(text, method, output=None, save_path=None, max_event_rate=PROGRESS_EVENTS_PER_SECOND,
+                result_mode="pdf", cache=None):
+    """
+    Analyses a text held in memory, yielding the progress, partial results and the result as SSE messages.
+    Nothing is written to disk: the start and end offsets and prediction of every classified span are kept
+    in output["spans"], and in "pdf" result mode the highlighted document is kept as bytes in output["pdf"]
+    and only saved if a save_path is given. With a ResultCache, a text already analysed by the same method
+    and classifier is answered from the cache. The "all" method combines the three methods, see detect_all
+    :param text: str
+    :param method: str
+    :param output: dict or NoneType
+    :param save_path: str or NoneType
+    :param max_event_rate: float, most progress events per second
+    :param result_mode: str, "pdf" or "spans"
+    :param cache: ResultCache or NoneType
+    :return: generator <str>
+    """
+    if method == "all":
+        yield from detect_all(text, output, save_path, result_mode, cache)
+        return
+    if method not in METHODS:
+        return
+
+    loaded = classifiers.get_loaded(method)  # The classifier and its version, from the same pickle
+    version = loaded.version
+    cached = cache.get(text, method, version) if cache is not None else None
+    if cached is not None:
+        yield 'data: {}\n\n'.format(0)
+        result, confidence_level, spans = cached["verdict"], cached["confidence"], cached["spans"]
+
+    elif method == "dependency_tree":
         yield 'data: {}\n\n'.format(0)
-        model = load_model("dependency_tree/dt_classifier.pickle")
-        sentences = split_into_sentences(txt_path)
-        total_sentences = []
-        highlighted_sentences = []
+        model = loaded.model
+        sentences = (span for span in iter_sentence_spans(text) if len(span[2].split()) > 5)
+        sentences, texts = itertools.tee(sentences)
+        texts = (s for _, _, s in texts)
+        spans = []
+        highlighted_sentences = 0
         predictions = []
+        progress = ProgressReporter(len(text), max_rate=max_event_rate)
         yield 'data: {}\n\n'.format(10)
-        for s in sentences:
-            if len(s.split()) > 5:
-                features = dependency_tree_feature_extraction(s)
-                df = pandas.DataFrame([features])
-                prediction = model.predict(df)[0]
-                predictions.append(prediction)
-                total_sentences.append(s)
-                if prediction == "machine-translated":
-                    highlighted_sentences.append(s)
-        yield 'data: {}\n\n'.format(80)
+        rows = zip(sentences, dependency_tree_feature_extraction_batch(texts))
+        for (start, end, _), prediction in predict_in_chunks(model, rows, max_delay=progress.min_interval):
+            predictions.append(prediction)
+            spans.append((start, end, prediction))
+            if prediction == "machine-translated":
+                highlighted_sentences += 1
+            yield from progress.add(prediction, end)
+        yield from progress.events(len(text))  # Reaches 80 percent and reports the last flagged units
+        if not spans:
+            raise NoUnitsError("No sentence of the text has more than 5 words")
         result = Counter(predictions).most_common(1)[0][0]
-        doc = open_pdf(pdf_path)
-        for hs in highlighted_sentences:
-            doc = highlight_pdf(doc, hs)
-        save_pdf(doc, highlighted_pdf_path)
-        yield 'data: {}\n\n'.format(100)
-        confidence_level = str(round((len(highlighted_sentences) / len(total_sentences)) * 100)) + " %"
-        yield 'data: {}\n\n'.format(result + "," + str(confidence_level))
-        doc.close()
-        os.remove(txt_path)
-        os.remove(pdf_path)
-        print("Removed..")
+        confidence_level = str(round((highlighted_sentences / len(spans)) * 100)) + " %"
 
     elif method == "word_embedding":
         yield 'data: {}\n\n'.format(0)
-        model = load_model("word_embedding/we_classifier.pickle")
-        paragraphs = split_into_paragraphs(txt_path)
-        total_paragraphs = []
-        highlighted_paragraphs = []
+        model = loaded.model
+        spans = []
+        highlighted_paragraphs = 0
         predictions = []
+        progress = ProgressReporter(len(text), max_rate=max_event_rate)
         yield 'data: {}\n\n'.format(10)
-        for p in paragraphs:
-            lemmas = lemmatise(p)
-            if len(lemmas) > 50:
-                features = word_embedding_feature_extraction(lemmas)
-                means = features[0]
-                variances = features[1]
-                df = pandas.DataFrame([means + variances])
-                prediction = model.predict(df)[0]
-                predictions.append(prediction)
-                total_paragraphs.append(p)
-                if prediction == "machine-translated":
-                    highlighted_paragraphs.append(p)
-        yield 'data: {}\n\n'.format(80)
+        rows = word_embedding_rows(iter_paragraph_spans(text))
+        for (start, end, _), prediction in predict_in_chunks(model, rows, max_delay=progress.min_interval):
+            predictions.append(prediction)
+            spans.append((start, end, prediction))
+            if prediction == "machine-translated":
+                highlighted_paragraphs += 1
+            yield from progress.add(prediction, end)
+        yield from progress.events(len(text))  # Reaches 80 percent and reports the last flagged units
+        if not spans:
+            raise NoUnitsError("No paragraph of the text is long enough for the word-embedding method")
         result = Counter(predictions).most_common(1)[0][0]
-        doc = open_pdf(pdf_path)
-        for hp in highlighted_paragraphs:
-            doc = highlight_pdf(doc, hp)
-        save_pdf(doc, highlighted_pdf_path)
-        print(len(highlighted_paragraphs))
-        print(len(total_paragraphs))
-        print(predictions)
-        confidence_level = str(round((len(highlighted_paragraphs) / len(total_paragraphs)) * 100)) + " %"
-        yield 'data: {}\n\n'.format(100)
-        yield 'data: {}\n\n'.format(result + "," + str(confidence_level))
-        doc.close()
-        os.remove(txt_path)
-        os.remove(pdf_path)
-        print("Removed..")
-
-    elif method == "word_distribution":
+        confidence_level = str(round((highlighted_paragraphs / len(spans)) * 100)) + " %"
+
+    else:
         yield 'data: {}\n\n'.format(0)
-        model = load_model("word_distribution/wd_classifier.pickle")
+        model = loaded.model
         confidence_level = "N/A"
         yield 'data: {}\n\n'.format(10)
-        features = word_distribution_feature_extraction(txt_path)
-        features = [features]
+        features = word_distribution_feature_extraction_from_text(text)
         yield 'data: {}\n\n'.format(50)
-        df = pandas.DataFrame(features)
-        result = model.predict(df)[0]
-        doc = open_pdf(pdf_path)
-        if result == "machine_translated":
-            with open(file, mode="r", encoding="utf-8-sig") as f:
-                content = f.read()
-                doc = highlight_pdf(doc, content)
-        save_pdf(doc, highlighted_pdf_path)
-        yield 'data: {}\n\n'.format(100)
-        yield 'data: {}\n\n'.format(result + "," + str(confidence_level))
-        doc.close()
-        os.remove(txt_path)
-        os.remove(pdf_path)
-        print("Removed..")
+        result = model.predict(np.array([features], dtype=float))[0]
+        spans = [(0, len(text), result)]  # The whole document is one span
+
+    if cache is not None and cached is None:
+        cache.set(text, method, version, {"verdict": result, "confidence": confidence_level, "spans": spans})
+    if output is not None:
+        output["verdict"] = result
+        output["confidence"] = confidence_level
+        output["version"] = version
+    yield from finish_result(text, spans, result_mode, output, save_path)
+    yield 'data: {}\n\n'.format(100)
+    yield 'data: {}\n\n'.format(result + "," + str(confidence_level))
+
+
+def exit_with_parent(parent_pid):
+    """
+    Makes a process of the ensemble pool exit once the process that started the pool is gone, e.g. a worker
+    of the web app killed for using too much memory, instead of waiting for work forever
+    :param parent_pid: int
+    :return: None
+    """
+    def watch():
+        while os.getppid() == parent_pid:
+            time.sleep(1.0)
+        os._exit(0)
+
+    threading.Thread(target=watch, daemon=True).start()
+
+
+def start_ensemble_pool(processes=ENSEMBLE_PROCESSES):
+    """
+    Starts the process pool of the "all" method, by default with one process per method. The processes are forked,
+    so they start with the spaCy pipelines and the classifiers already loaded. Only the forking thread exists in
+    a forked process, so the pool is started before the process starts any thread and never from a request.
+    With no processes, no pool is started and the methods of a document run one after the other
+    :param processes: int
+    :return: ProcessPoolExecutor or NoneType
+    """
+    global ensemble_executor
+    if processes <= 0:
+        with ensemble_lock:
+            ensemble_executor = None
+        return None
+    pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("fork"),
+                               initializer=exit_with_parent, initargs=(os.getpid(),))
+    pool.submit(os.getpid).result()  # Forks every process now rather than when the first document arrives
+    with ensemble_lock:
+        ensemble_executor = pool
+    return pool
+
+
+def detect_method(text, method):
+    """
+    Analyses a text with one method in a process of the ensemble pool. The verdict is None if the text
+    has no unit long enough for the method
+    :param text: str
+    :param method: str
+    :return: dict, with the verdict, confidence, spans, version of the classifier and the seconds the method took
+    """
+    start = time.perf_counter()
+    output = {}
+    try:
+        for _ in detect_text(text, method, output, result_mode="spans"):
+            pass
+    except NoUnitsError:
+        return {"verdict": None, "confidence": "N/A", "spans": [], "version": classifiers.version(method),
+                "seconds": round(time.perf_counter() - start, 3)}
+    return {"verdict": output["verdict"], "confidence": output["confidence"], "spans": output["spans"],
+            "version": output["version"], "seconds": round(time.perf_counter() - start, 3)}
+
+
+def compute_methods(text, methods):
+    """
+    Analyses a text with several methods, yielding the result of each method as soon as it is known. The methods
+    run at once in the ensemble pool, at most ENSEMBLE_DOCUMENTS documents at a time. Without a pool, because
+    none was started or its processes died, they run one after the other in the calling thread
+    :param text: str
+    :param methods: list <str>
+    :return: generator <(str, dict)>
+    """
+    global ensemble_executor
+    with ensemble_lock:
+        pool = ensemble_executor
+    if pool is None:
+        for method in methods:
+            yield method, detect_method(text, method)
+        return
+
+    with ensemble_slots:
+        futures = {}
+        try:
+            for method in methods:
+                futures[pool.submit(detect_method, text, method)] = method
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        except BrokenProcessPool:
+            # A process died, e.g. out of memory. A new pool would be forked from the threads of the web app,
+            # so the next documents are analysed without one until the web app is restarted
+            with ensemble_lock:
+                if ensemble_executor is pool:
+                    ensemble_executor = None
+            raise
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def run_methods(text, cache=None):
+    """
+    Analyses a text with every method, yielding the result of each method as soon as it is known.
+    Results found in the cache come first, then those of the other methods as they are computed
+    :param text: str
+    :param cache: ResultCache or NoneType
+    :return: generator <(str, dict)>
+    """
+    cached = {}
+    for method in METHODS:
+        version = classifiers.version(method)
+        result = cache.get(text, method, version) if cache is not None else None
+        if result is not None:
+            cached[method] = dict(result, version=version, seconds=0.0)
+
+    yield from cached.items()
+    for method, result in compute_methods(text, [method for method in METHODS if method not in cached]):
+        if cache is not None and result["verdict"] is not None:  # Otherwise detect_text would answer None
+            # Under the version of the classifier that the process used, which may have been reloaded
+            cache.set(text, method, result["version"], {key: result[key] for key in ("verdict", "confidence", "spans")})
+        yield method, result
+
+
+def ensemble_spans(sentence_spans, paragraph_spans, document_verdict):
+    """
+    Predicts every sentence by the majority of the prediction of the sentence by the dependency-tree method,
+    of the paragraph containing it by the word-embedding method and of the document by the word-distribution
+    method. Sentences of paragraphs too short for the word-embedding method have two votes, a tie is decided
+    by the prediction of the sentence. Without any sentence long enough for the dependency-tree method,
+    the paragraphs are predicted by the word-embedding method alone, since its prediction decides a tie
+    :param sentence_spans: list <(int, int, str)>
+    :param paragraph_spans: list <(int, int, str)>
+    :param document_verdict: str
+    :return: list <(int, int, str)>
+    """
+    if not sentence_spans:
+        return list(paragraph_spans)
+    spans = []
+    paragraphs = iter(paragraph_spans)
+    paragraph = next(paragraphs, None)
+    for start, end, prediction in sentence_spans:
+        while paragraph is not None and paragraph[1] <= start:
+            paragraph = next(paragraphs, None)
+        votes = [prediction, document_verdict]
+        if paragraph is not None and paragraph[0] <= start:
+            votes.insert(1, paragraph[2])
+        spans.append((start, end, Counter(votes).most_common(1)[0][0]))
+    return spans
+
+
+def detect_all(text, output=None, save_path=None, result_mode="pdf", cache=None):
+    """
+    Analyses a text with the three methods concurrently, yielding the result of each method as a "method"
+    SSE message as soon as it is known, then the verdict of the majority of the methods. Methods finding no unit
+    long enough in the text have no verdict and do not vote. The confidence of the verdict is the share of voting
+    methods that agree with it, the confidence of every method is kept in output["methods"].
+    The combined result is cached under the versions of the three classifiers
+    :param text: str
+    :param output: dict or NoneType
+    :param save_path: str or NoneType
+    :param result_mode: str, "pdf" or "spans"
+    :param cache: ResultCache or NoneType
+    :return: generator <str>
+    """
+    yield sse(0)
+    version = "+".join(classifiers.version(method) for method in METHODS)
+    cached = cache.get(text, "all", version) if cache is not None else None
+    yield sse(10)
+    if cached is not None:
+        result, confidence_level, spans = cached["verdict"], cached["confidence"], cached["spans"]
+        methods = {method: dict(cached["methods"][method], seconds=0.0) for method in METHODS}
+        for method in METHODS:
+            yield sse(json.dumps(dict(method=method, **methods[method])), event="method")
+        yield sse(80)
+
+    else:
+        results = {}
+        for method, method_result in run_methods(text, cache):
+            results[method] = method_result
+            summary = {"method": method, "verdict": method_result["verdict"],
+                       "confidence": method_result["confidence"], "seconds": method_result["seconds"]}
+            yield sse(json.dumps(summary), event="method")
+            yield sse(10 + round(70 * len(results) / len(METHODS)))
+
+        verdicts = [results[method]["verdict"] for method in METHODS if results[method]["verdict"] is not None]
+        if not verdicts:
+            raise NoUnitsError("No method found a unit long enough in the text")
+        result, votes = Counter(verdicts).most_common(1)[0]
+        confidence_level = str(round(votes / len(verdicts) * 100)) + " %"
+        spans = ensemble_spans(results["dependency_tree"]["spans"], results["word_embedding"]["spans"],
+                               results["word_distribution"]["verdict"])
+        methods = {method: {key: results[method][key] for key in ("verdict", "confidence", "seconds")}
+                   for method in METHODS}
+        if cache is not None:
+            # Under the versions the methods were computed with, which may have been reloaded since the lookup
+            version = "+".join(results[method]["version"] for method in METHODS)
+            cache.set(text, "all", version, {"verdict": result, "confidence": confidence_level, "spans": spans,
+                                             "methods": methods})
+
+    if output is not None:
+        output["verdict"] = result
+        output["confidence"] = confidence_level
+        output["methods"] = methods
+    yield from finish_result(text, spans, result_mode, output, save_path)
+    yield sse(100)
+    yield sse(result + "," + confidence_level)
+
+
+def detect(txt_path, method, result_dir="./static/results", max_event_rate=PROGRESS_EVENTS_PER_SECOND):
+    """
+    Analyses an uploaded text file and deletes it, yielding the progress, partial results and the result
+    as SSE messages. The highlighted document is saved as result.pdf in result_dir
+    :param txt_path: str
+    :param method: str
+    :param result_dir: str
+    :param max_event_rate: float, most progress events per second
+    :return: generator <str>
+    """
+    with open(txt_path, mode="r", encoding="utf-8-sig") as f:
+        text = f.read()
+    yield from detect_text(text, method, save_path=os.path.join(result_dir, "result.pdf"),
+                           max_event_rate=max_event_rate)
+    os.remove(txt_path)
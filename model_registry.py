@@ -0,0 +1,151 @@
+import hashlib
+import os
+import pickle
+import threading
+import time
+
+"""
+This file contains a registry of the trained classifiers used by the web app. Every classifier is unpickled
+once and shared by all request threads, and is reloaded when its pickle changes on disk
+"""
+
+CLASSIFIER_PATHS = {
+    "dependency_tree": "dependency_tree/dt_classifier.pickle",
+    "word_embedding": "word_embedding/we_classifier.pickle",
+    "word_distribution": "word_distribution/wd_classifier.pickle",
+}
+
+
+class LoadedModel:
+    def __init__(self, model, path, mtime, size, version, loaded_at, load_seconds):
+        self.model = model
+        self.path = path
+        self.mtime = mtime
+        self.size = size
+        self.version = version  # Hash of the pickle, changes whenever the classifier is retrained
+        self.loaded_at = loaded_at
+        self.load_seconds = load_seconds
+
+
+class ModelRegistry:
+    def __init__(self, paths=CLASSIFIER_PATHS, check_interval=2.0):
+        self.paths = dict(paths)
+        self.check_interval = check_interval  # Seconds between two checks of the same pickle on disk
+        self.models = {}
+        self.last_check = {}
+        self.reloads = {method: 0 for method in self.paths}
+        self.errors = {}
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def add_listener(self, listener):
+        """
+        Registers a function called as listener(method, old_version, new_version) after a classifier is reloaded,
+        e.g. to invalidate results computed with the old classifier
+        :param listener: function
+        :return: None
+        """
+        self.listeners.append(listener)
+
+    def load(self, method):
+        """
+        Unpickles the classifier of a method, without touching the classifier currently in use
+        :param method: str
+        :return: LoadedModel
+        """
+        path = self.paths[method]
+        start = time.perf_counter()
+        stat = os.stat(path)
+        with open(path, "rb") as f:
+            data = f.read()
+        model = pickle.loads(data)
+        return LoadedModel(model, path, stat.st_mtime, stat.st_size, hashlib.sha256(data).hexdigest()[:12],
+                           time.time(), time.perf_counter() - start)
+
+    def load_all(self):
+        """
+        Loads every classifier, to be called once when the app starts
+        :return: None
+        """
+        for method in self.paths:
+            self.get(method)
+
+    def is_stale(self, loaded):
+        try:
+            stat = os.stat(loaded.path)
+        except OSError:  # The pickle is being replaced, keep the loaded classifier
+            return False
+        return stat.st_mtime != loaded.mtime or stat.st_size != loaded.size
+
+    def get_loaded(self, method):
+        """
+        Finds the loaded classifier of a method, loading it the first time and reloading it if its pickle changed.
+        A classifier is swapped in only once the new pickle is fully loaded, so requests in flight keep the old one
+        :param method: str
+        :return: LoadedModel
+        """
+        loaded = self.models.get(method)
+        now = time.monotonic()
+        if loaded is not None and now - self.last_check.get(method, 0) < self.check_interval:
+            return loaded
+
+        with self.lock:
+            loaded = self.models.get(method)
+            self.last_check[method] = now
+            if loaded is not None and not self.is_stale(loaded):
+                return loaded
+            try:
+                new = self.load(method)
+            except Exception as e:
+                if loaded is None:
+                    raise
+                # A pickle that is still being written cannot be loaded yet, try again at the next check
+                self.errors[method] = "{}: {}".format(type(e).__name__, e)
+                return loaded
+            if loaded is not None:
+                self.reloads[method] += 1
+            self.errors.pop(method, None)
+            self.models[method] = new
+
+        if loaded is not None and loaded.version != new.version:
+            for listener in self.listeners:
+                listener(method, loaded.version, new.version)
+        return new
+
+    def get(self, method):
+        """
+        Finds the classifier of a method
+        :param method: str
+        :return: sklearn classifier
+        """
+        return self.get_loaded(method).model
+
+    def version(self, method):
+        return self.get_loaded(method).version
+
+    def health(self):
+        """
+        Reports the version and load time of every loaded classifier
+        :return: dict
+        """
+        report = {}
+        for method, path in self.paths.items():
+            loaded = self.models.get(method)
+            if loaded is None:
+                report[method] = {"loaded": False, "path": path}
+                continue
+            report[method] = {
+                "loaded": True,
+                "path": path,
+                "version": loaded.version,
+                "modified_at": loaded.mtime,
+                "loaded_at": loaded.loaded_at,
+                "load_seconds": round(loaded.load_seconds, 4),
+                "reloads": self.reloads[method],
+            }
+            if method in self.errors:
+                report[method]["reload_error"] = self.errors[method]
+        return report
+
+
+classifiers = ModelRegistry()
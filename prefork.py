@@ -0,0 +1,370 @@
+import atexit
+import gc
+import multiprocessing
+import os
+import queue
+import select
+import signal
+import socket
+import threading
+import time
+import traceback
+
+from annotation import lemmatiser, nlp
+from main import detect_text, start_ensemble_pool
+from model_registry import classifiers
+from multiprocessing.connection import Connection, wait
+from multiprocessing.reduction import recvfds, sendfds
+from word_embedding import get_glove_store
+
+"""
+This file contains the pre-forked worker pool of the web app. The spaCy pipeline, the classifiers and the GloVe
+embedding store are loaded once in the web app, which then forks a zygote: a process with a single thread that
+forks every worker, at startup and whenever a worker exits, so that every worker shares those pages copy-on-write
+and none is forked from the threads of the web app. Every document is analysed by an idle worker, so that documents
+are analysed in parallel without every worker contending for the GIL of the web app or loading its own copy
+of the models (Linux only)
+"""
+
+DOCUMENT_TIMEOUT = 600  # Seconds a worker may take to analyse a document before it is killed
+CLOSE_TIMEOUT = 30  # Seconds the workers may take to finish their document when the pool is closed
+
+
+class WorkerError(Exception):
+    pass
+
+
+def process_memory(pid):
+    """
+    Finds the resident (RSS) and proportional (PSS) memory of a process in bytes, the PSS counts
+    the pages shared with other processes divided by the number of processes sharing them (Linux only)
+    :param pid: int
+    :return: dict <str, int>
+    """
+    memory = {}
+    with open("/proc/{}/smaps_rollup".format(pid)) as f:
+        for line in f:
+            field, value = line.split(":", 1)
+            if field in ("Rss", "Pss"):
+                memory[field.lower()] = int(value.split()[0]) * 1024
+    return memory
+
+
+def preload():
+    """
+    Loads everything the workers share before they are forked, and moves the loaded objects out of reach
+    of the garbage collector so that collections in the workers do not write to (and copy) their pages
+    :return: None
+    """
+    classifiers.load_all()
+    get_glove_store()
+    nlp("Every component of the pipeline is loaded by parsing a first sentence.")
+    lemmatiser("Every component of the lemmatiser is loaded by lemmatising a first sentence.")
+    gc.collect()
+    gc.freeze()
+
+
+class Worker:
+    def __init__(self, pid, connection, sentinel):
+        self.pid = pid
+        self.connection = connection  # Parent end of the pipe to the worker
+        self.sentinel = sentinel  # Process file descriptor of the worker, readable once it exited
+        self.requests = 0
+
+    def is_alive(self):
+        return not wait([self.sentinel], timeout=0)
+
+    def kill(self):
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def close(self):
+        self.connection.close()
+        os.close(self.sentinel)
+
+
+class WorkerPool:
+    def __init__(self, size=2, cache=None, timeout=DOCUMENT_TIMEOUT, ensemble_processes=0):
+        self.size = size
+        self.cache = cache  # ResultCache used by the workers, or None
+        self.timeout = timeout  # Seconds a worker may take to analyse a document
+        # Processes of the pool of the "all" method started by every worker, 0 to run the methods one after the other
+        self.ensemble_processes = ensemble_processes
+        self.workers = []
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+        self.context = multiprocessing.get_context("fork")  # The workers must inherit the loaded models
+        self.zygote = None
+        self.zygote_socket = None  # Web app end of the socket to the zygote
+        self.zygote_lock = threading.Lock()
+
+    def start(self):
+        """
+        Loads the models and forks the zygote, which forks the workers, before the web app starts any thread
+        :return: None
+        """
+        preload()
+        self.zygote_socket, zygote_socket = socket.socketpair()
+        # Not a daemon, since it starts the workers
+        self.zygote = self.context.Process(target=self.serve_forks, args=(zygote_socket,))
+        self.zygote.start()
+        zygote_socket.close()
+        for _ in range(self.size):
+            self.idle.put(self.fork())
+        atexit.register(self.close)  # Before multiprocessing waits for the zygote at exit
+
+    def serve_forks(self, zygote_socket):
+        """
+        Runs in the zygote: forks a worker every time the web app asks for one, and sends the web app its end
+        of the pipe to the worker and a process file descriptor of the worker, which is not a child of the web app
+        :param zygote_socket: socket.socket
+        :return: None
+        """
+        self.zygote_socket.close()
+        while True:
+            ready, _, _ = select.select([zygote_socket], [], [], 1.0)
+            multiprocessing.active_children()  # Reaps the workers that exited
+            if not ready:
+                continue
+            if not zygote_socket.recv(1):
+                return  # The web app closed the pool or exited
+            connection, worker_connection = self.context.Pipe()
+            # Not a daemon, since the "all" method starts processes of its own
+            process = self.context.Process(target=self.serve, args=(worker_connection,))
+            process.start()
+            worker_connection.close()
+            sentinel = os.pidfd_open(process.pid)  # Before the worker can be reaped, so that its PID is not reused
+            sendfds(zygote_socket, [connection.fileno(), sentinel])
+            zygote_socket.sendall(process.pid.to_bytes(4, "big"))
+            connection.close()
+            os.close(sentinel)
+
+    def fork(self):
+        """
+        Has the zygote fork a worker
+        :return: Worker
+        """
+        with self.zygote_lock:
+            self.zygote_socket.sendall(b"f")
+            connection_fd, sentinel = recvfds(self.zygote_socket, 2)
+            pid = int.from_bytes(self.zygote_socket.recv(4, socket.MSG_WAITALL), "big")
+        worker = Worker(pid, Connection(connection_fd), sentinel)
+        with self.lock:
+            self.workers.append(worker)
+        return worker
+
+    def serve(self, connection):
+        """
+        Runs in a worker: analyses the documents sent by the web app, sending back every SSE message
+        and the values of the output of the detection, and reports its classifiers and result cache when asked
+        :param connection: multiprocessing.connection.Connection
+        :return: None
+        """
+        ensemble = start_ensemble_pool(self.ensemble_processes)  # While the worker has a single thread
+        try:
+            while True:
+                try:
+                    request = connection.recv()
+                except EOFError:
+                    return  # The web app exited
+                if request is None:
+                    return
+                if request[0] == "health":
+                    try:
+                        cache_stats = self.cache.stats() if self.cache is not None else None
+                        health = {"models": classifiers.health(), "result_cache": cache_stats}
+                    except Exception as e:
+                        traceback.print_exc()
+                        health = {"error": type(e).__name__}
+                    connection.send(("health", health))
+                    continue
+                _, text, method, result_mode = request
+                output = {}
+                sent = {}
+                try:
+                    for event in detect_text(text, method, output, result_mode=result_mode, cache=self.cache):
+                        # Values of the output are sent before the event announcing them, as they are set
+                        changed = {key: value for key, value in output.items() if sent.get(key) is not value}
+                        if changed:
+                            connection.send(("output", changed))
+                            sent.update(changed)
+                        connection.send(("event", event))
+                    changed = {key: value for key, value in output.items() if sent.get(key) is not value}
+                    connection.send(("done", changed))
+                except Exception as e:
+                    traceback.print_exc()
+                    connection.send(("error", type(e).__name__))
+        finally:
+            if ensemble is not None:
+                ensemble.shutdown()  # The worker would otherwise wait for the processes of the pool when it exits
+
+    def detect_text(self, text, method, output=None, save_path=None, result_mode="pdf", cache=None):
+        """
+        Analyses a text in an idle worker, waiting for one if they are all busy. Behaves like main.detect_text,
+        the result cache given to the pool is used instead of cache
+        :param text: str
+        :param method: str
+        :param output: dict or NoneType
+        :param save_path: str or NoneType
+        :param result_mode: str, "pdf" or "spans"
+        :param cache: ResultCache or NoneType, ignored
+        :return: generator <str>
+        """
+        worker = self.idle.get()
+        deadline = time.monotonic() + self.timeout
+        finished = False
+        try:
+            worker.requests += 1
+            request = ("detect", text, method, result_mode)
+            while True:
+                # Only errors of the pipe mean that the worker died, errors of the web app are raised as they are
+                try:
+                    if request is not None:
+                        worker.connection.send(request)
+                        request = None
+                    kind, value = self.receive(worker, deadline)
+                except TimeoutError:
+                    finished = True
+                    worker = self.replace(worker)
+                    raise WorkerError("The worker took more than {} seconds to analyse the document"
+                                      .format(self.timeout))
+                except (EOFError, OSError):
+                    finished = True
+                    worker = self.replace(worker)  # The worker died, e.g. killed for using too much memory
+                    raise WorkerError("The worker analysing the document exited")
+                if kind == "health":
+                    continue  # Answer to a health check that stopped waiting for it
+                if kind == "event":
+                    yield value
+                    continue
+                if kind == "error":
+                    finished = True
+                    raise WorkerError(value)
+                if output is not None:
+                    output.update(value)
+                if save_path is not None and value.get("pdf") is not None:
+                    with open(save_path, mode="wb") as f:
+                        f.write(value["pdf"])
+                if kind == "done":
+                    finished = True
+                    return
+        finally:
+            if not finished:
+                try:
+                    self.drain(worker, deadline)
+                except (EOFError, OSError):
+                    worker = self.replace(worker)
+            self.idle.put(worker)
+
+    def receive(self, worker, deadline):
+        """
+        Waits for the next message of a worker until a deadline. The processes started by a worker for the "all"
+        method keep its end of the pipe open, so a worker that died is noticed by waiting on its process as well
+        :param worker: Worker
+        :param deadline: float, time.monotonic() after which TimeoutError is raised
+        :return: (str, any)
+        """
+        while True:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                raise TimeoutError("Worker {} did not answer in time".format(worker.pid))
+            ready = wait([worker.connection, worker.sentinel], timeout)
+            if worker.connection in ready:
+                return worker.connection.recv()
+            if worker.sentinel in ready:
+                raise EOFError("Worker {} exited".format(worker.pid))
+
+    def drain(self, worker, deadline):
+        """
+        Reads the remaining messages of a detection that was abandoned, so that the next document sent
+        to the worker does not receive them
+        :param worker: Worker
+        :param deadline: float
+        :return: None
+        """
+        kind = "event"
+        while kind not in ("done", "error"):
+            kind, _ = self.receive(worker, deadline)
+
+    def replace(self, worker):
+        """
+        Kills a worker that exited or stopped answering, and has the zygote fork a new one in its place
+        :param worker: Worker
+        :return: Worker
+        """
+        with self.lock:
+            if worker not in self.workers:
+                return worker  # Already killed and closed when the pool was closed
+            self.workers.remove(worker)
+        worker.kill()
+        worker.close()
+        return self.fork()
+
+    def health(self, timeout=1.0):
+        """
+        Reports the process, requests and memory of every worker. Idle workers also report their classifiers
+        and result cache, busy workers cannot answer before their document is analysed
+        :param timeout: float, seconds to wait for an idle worker to answer
+        :return: list <dict>
+        """
+        idle = []
+        while True:
+            try:
+                idle.append(self.idle.get_nowait())
+            except queue.Empty:
+                break
+        answers = {}
+        try:
+            for worker in idle:
+                try:
+                    worker.connection.send(("health",))
+                    _, answers[worker] = self.receive(worker, time.monotonic() + timeout)
+                except (EOFError, OSError):
+                    pass  # Replaced when it is sent the next document
+        finally:
+            for worker in idle:
+                self.idle.put(worker)
+
+        with self.lock:
+            workers = list(self.workers)
+        report = []
+        for worker in workers:
+            entry = {"pid": worker.pid, "alive": worker.is_alive(), "busy": worker not in idle,
+                     "requests": worker.requests}
+            entry.update(answers.get(worker, {}))
+            try:
+                entry.update(process_memory(worker.pid))
+            except OSError:
+                pass
+            report.append(entry)
+        return report
+
+    def close(self, timeout=CLOSE_TIMEOUT):
+        """
+        Stops the workers once they have finished their current document, then the zygote. The workers
+        still analysing a document after timeout seconds are killed
+        :param timeout: float
+        :return: None
+        """
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            workers = list(self.workers)
+            self.workers = []
+        for worker in workers:
+            try:
+                worker.connection.send(None)
+            except OSError:
+                pass
+        for worker in workers:
+            if not wait([worker.sentinel], max(0.0, deadline - time.monotonic())):
+                worker.kill()
+            worker.close()
+        if self.zygote is not None:
+            self.zygote_socket.close()  # The zygote waits for the workers it forked, which exited or were killed
+            self.zygote.join(max(1.0, deadline - time.monotonic()))
+            if self.zygote.is_alive():
+                self.zygote.kill()
+                self.zygote.join()
+            self.zygote = None
@@ -0,0 +1,59 @@
+import hashlib
+
+from cache import SQLiteCache
+
+"""
+This file contains the cache of detection results used by the web app. A result is stored under the hash of
+the uploaded text, the method and the version of the classifier that produced it, so that uploading the same
+document again with the same method is answered without analysing it again
+"""
+
+RESULT_CACHE_PATH = "cache/result_cache.sqlite"  # Outside static/, which the web app serves to anyone
+RESULT_CACHE_TTL = 7 * 24 * 3600  # Seconds a result is kept after it was computed
+RESULT_CACHE_SIZE = 10000
+
+
+def text_hash(text):
+    """
+    Computes the hash of a text. Texts are decoded with decode_text, so uploads that only differ in their
+    byte order mark or line endings have the same hash. Other differences change the offsets of the spans
+    :param text: str
+    :return: str
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, path=RESULT_CACHE_PATH, max_entries=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL):
+        self.cache = SQLiteCache(path, max_entries=max_entries, ttl=ttl)
+
+    def key(self, text, method, version):
+        return "{}:{}:{}".format(method, version, text_hash(text))
+
+    def get(self, text, method, version):
+        """
+        Finds the result of a text analysed by a method with a given version of its classifier
+        :param text: str
+        :param method: str
+        :param version: str
+        :return: dict or NoneType, with the verdict, confidence and spans
+        """
+        return self.cache.get(self.key(text, method, version))
+
+    def set(self, text, method, version, result):
+        self.cache.set(self.key(text, method, version), result)
+
+    def invalidate(self, method, old_version, new_version=None):
+        """
+        Deletes the results of a method computed with an old version of its classifier, and the combined
+        results of the "all" method, to be registered as a listener of the model registry
+        :param method: str
+        :param old_version: str
+        :param new_version: str
+        :return: None
+        """
+        self.cache.delete_prefix("{}:{}:".format(method, old_version))
+        self.cache.delete_prefix("all:")
+
+    def stats(self):
+        return self.cache.stats()
@@ -0,0 +1,137 @@
+from nltk import tokenize
+
+"""
+This file contains functions that split a text file into sentences or paragraphs while it is being read,
+so that very large documents never have to be held in memory at once
+"""
+
+CHUNK_SIZE = 64 * 1024  # Characters read from the file at a time
+
+
+def read_chunks(path, chunk_size=CHUNK_SIZE, encoding="utf-8"):
+    """
+    Reads a text file in chunks of characters
+    :param path: str
+    :param chunk_size: int
+    :param encoding: str
+    :return: generator <str>
+    """
+    with open(path, mode="r", encoding=encoding) as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def decode_text(data, encoding="utf-8-sig"):
+    """
+    Decodes an uploaded file held in memory, translating its line endings to "\n" as when reading it from disk
+    :param data: bytes
+    :param encoding: str
+    :return: str
+    """
+    return data.decode(encoding).replace("\r\n", "\n").replace("\r", "\n")
+
+
+def text_chunks(text, chunk_size=CHUNK_SIZE):
+    """
+    Splits a text held in memory into chunks of characters, like read_chunks does for a file
+    :param text: str
+    :param chunk_size: int
+    :return: generator <str>
+    """
+    for i in range(0, len(text), chunk_size):
+        yield text[i:i + chunk_size]
+
+
+def iter_paragraphs(chunks):
+    """
+    Splits a text given in chunks into paragraphs, yielding each paragraph as soon as it is complete.
+    Gives the same paragraphs as splitting the whole text on blank lines
+    :param chunks: iterable <str>
+    :return: generator <str>
+    """
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk
+        if "\n\n" not in buffer[-len(chunk) - 1:]:  # No paragraph ended in this chunk
+            continue
+        paragraphs = buffer.split("\n\n")
+        buffer = paragraphs.pop()  # The last paragraph may continue in the next chunk
+        for p in paragraphs:
+            yield p.replace("\n", " ")
+    yield buffer.replace("\n", " ")
+
+
+def iter_sentences(chunks):
+    """
+    Splits a text given in chunks into sentences, yielding each sentence as soon as it is complete.
+    The last two sentences of the text read so far are held back, so that every sentence boundary is
+    decided with the whole of the next word available, as when tokenising the whole text at once
+    :param chunks: iterable <str>
+    :return: generator <str>
+    """
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk.replace("\n", " ")
+        sentences = tokenize.sent_tokenize(buffer)
+        if len(sentences) <= 2:
+            continue
+
+        # Find where the held back sentences start in the buffer
+        position = 0
+        for s in sentences[:-2]:
+            position = buffer.index(s, position) + len(s)
+            yield s
+        buffer = buffer[buffer.index(sentences[-2], position):]
+
+    yield from tokenize.sent_tokenize(buffer)
+
+
+def iter_paragraph_spans(text, chunk_size=CHUNK_SIZE):
+    """
+    Splits a text held in memory into paragraphs, yielding the start and end offset of each paragraph
+    in the text along with the paragraph, as given by iter_paragraphs
+    :param text: str
+    :param chunk_size: int
+    :return: generator <(int, int, str)>
+    """
+    start = 0
+    for p in iter_paragraphs(text_chunks(text, chunk_size)):
+        yield start, start + len(p), p
+        start += len(p) + 2  # Paragraphs keep their length and are separated by a blank line
+
+
+def iter_sentence_spans(text, chunk_size=CHUNK_SIZE):
+    """
+    Splits a text held in memory into sentences, yielding the start and end offset of each sentence
+    in the text along with the sentence, as given by iter_sentences
+    :param text: str
+    :param chunk_size: int
+    :return: generator <(int, int, str)>
+    """
+    flat_text = text.replace("\n", " ")  # The text as seen by iter_sentences, with the same offsets
+    position = 0
+    for s in iter_sentences(text_chunks(text, chunk_size)):
+        start = flat_text.index(s, position)
+        position = start + len(s)
+        yield start, position, s
+
+
+def split_into_sentences(path):
+    """
+    Splits a given .txt file to a list of sentences.
+    :param path: str
+    :return: list <str>
+    """
+    return list(iter_sentences(read_chunks(path)))
+
+
+def split_into_paragraphs(path):
+    """
+    Splits a text file into list of paragraphs
+    :param path: str
+    :return: list <str>
+    """
+    return list(iter_paragraphs(read_chunks(path)))
@@ -0,0 +1,60 @@
+import main
+import pytest
+
+from model_registry import LoadedModel
+
+# This file contains tests of the "all" method when one of the methods finds no unit long enough in the text
+
+TEXT = "The cat sat on the mat and looked at the garden for a while.\n\nIt was a quiet and sunny afternoon."
+
+
+class ConstantModel:
+    def __init__(self, prediction):
+        self.prediction = prediction
+
+    def predict(self, rows):
+        return [self.prediction] * len(rows)
+
+
+@pytest.fixture
+def classifiers(monkeypatch):
+    models = {method: LoadedModel(ConstantModel("machine-translated"), "", 0, 0, "v1", 0, 0)
+              for method in main.METHODS}
+    monkeypatch.setattr(main.classifiers, "get_loaded", models.get)
+    monkeypatch.setattr(main.classifiers, "version", lambda method: models[method].version)
+    monkeypatch.setattr(main, "ensemble_executor", None)  # The methods run in the calling thread
+    return models
+
+
+def test_detect_text_without_units(classifiers):
+    with pytest.raises(main.NoUnitsError):
+        list(main.detect_text(TEXT, "word_embedding"))
+
+
+def test_detect_method_without_units(classifiers):
+    result = main.detect_method(TEXT, "word_embedding")
+    assert result["verdict"] is None
+    assert result["spans"] == []
+    assert result["version"] == "v1"
+
+
+def test_detect_all_with_one_empty_method(classifiers):
+    output = {}
+    events = list(main.detect_all(TEXT, output, result_mode="spans"))
+
+    assert output["verdict"] == "machine-translated"
+    assert output["confidence"] == "100 %"  # Two methods voted, both for the verdict
+    assert output["methods"]["word_embedding"]["verdict"] is None
+    assert output["methods"]["dependency_tree"]["verdict"] == "machine-translated"
+    assert [span[2] for span in output["spans"]] == ["machine-translated"] * len(output["spans"])
+    assert events[-1] == main.sse("machine-translated,100 %")
+
+
+def test_detect_all_without_units(classifiers, monkeypatch):
+    def no_units(text, cache=None):
+        for method in main.METHODS:
+            yield method, {"verdict": None, "confidence": "N/A", "spans": [], "version": "v1", "seconds": 0.0}
+
+    monkeypatch.setattr(main, "run_methods", no_units)
+    with pytest.raises(main.NoUnitsError):
+        list(main.detect_all(TEXT, result_mode="spans"))
@@ -4,10 +4,12 @@ import os
 import pandas
 import pickle
 
-from back_translation import back_translation_feature_extraction, back_translate
-from dependency_tree import split_into_sentences, dependency_tree_feature_extraction
+from annotation import lemma_cache, pipe_lemmas_and_tags
+from back_translation import back_translation_feature_extraction_batch, back_translate_batch
+from dependency_tree import dependency_tree_feature_extraction_batch
+from segmentation import split_into_paragraphs, split_into_sentences
 from word_distribution import word_distribution_feature_extraction
-from word_embedding import split_into_paragraphs, word_embedding_feature_extraction, lemmatise
+from word_embedding import word_embedding_feature_extraction, N_FEATURES
 
 from sklearn.linear_model import SGDClassifier
 from sklearn.metrics import accuracy_score, classification_report, confusion_matrix
@@ -122,15 +124,30 @@ def evaluate(filename, method):
     print(accuracy_score(result_test, pred))
 
 
-def batch_save_features(method, root, result, save_path):
+def save_back_translation_features(sentences, result, save_path):
+    """
+    Back-translates a batch of sentences together and saves their features to the csv file
+    :param sentences: list <str>
+    :param result: str
+    :param save_path: str
+    :return: None
+    """
+    for features in back_translation_feature_extraction_batch(sentences, back_translate_batch(sentences)):
+        save_features("back_translation", features, result, save_path)
+
+
+def batch_save_features(method, root, result, save_path, n_process=1, bt_batch_size=64):
     """
     Performs feature extraction for all the dataset, saving to its appropriate csv file
     :param method: str
     :param root: str
     :param result: str
     :param save_path: str
+    :param n_process: int
+    :param bt_batch_size: int, number of sentences back-translated together
     :return: None
     """
+    bt_sentences = []  # Sentences to back-translate together, saved every bt_batch_size sentences
     for sub_dir in os.scandir(root):
         for file in os.scandir(sub_dir.path):
             print(file.path)
@@ -139,29 +156,36 @@ def batch_save_features(method, root, result, save_path):
                 sentences = split_into_sentences(file.path)
                 for s in sentences:
                     if len(s.split()) > 5:
-                        bt_s = back_translate(s)
-                        features = back_translation_feature_extraction(source_text=s, back_translation=bt_s)
-                        save_features(method, features, result, save_path)
+                        bt_sentences.append(s)
                         break
+                if len(bt_sentences) >= bt_batch_size:
+                    save_back_translation_features(bt_sentences, result, save_path)
+                    bt_sentences = []
 
             elif method == "dependency_tree":
-                sentences = split_into_sentences(file.path)
-                for s in sentences:
-                    if len(s.split()) > 5:
-                        features = dependency_tree_feature_extraction(s)
-                        save_features(method, features, result, save_path)
+                sentences = [s for s in split_into_sentences(file.path) if len(s.split()) > 5]
+                for features in dependency_tree_feature_extraction_batch(sentences, n_process=n_process,
+                                                                         use_cache=True):
+                    save_features(method, features, result, save_path)
 
             elif method == "word_distribution":
-                features = word_distribution_feature_extraction(file.path)
+                features = word_distribution_feature_extraction(file.path, use_cache=True)
                 save_features(method, features, result, save_path)
 
             elif method == "word_embedding":
                 paragraphs = split_into_paragraphs(file.path)
-                for p in paragraphs:
-                    lemmas = lemmatise(p)
+                for lemmas, _ in pipe_lemmas_and_tags(paragraphs, use_cache=True):
                     if len(lemmas) > 50:
+                        # Tagged by nltk like the rows of the current classifier, rows with unknown tags are longer
                         features = word_embedding_feature_extraction(lemmas)
-                        save_features(method, features, result, save_path)
+                        if len(features[0]) + len(features[1]) == N_FEATURES:
+                            save_features(method, features, result, save_path)
+
+    if bt_sentences:
+        save_back_translation_features(bt_sentences, result, save_path)
+
+    if method in ("word_distribution", "word_embedding"):  # The only methods that look up the lemma cache
+        print("Lemma cache:", lemma_cache.stats())
 
 
 def recall(path):
@@ -1,106 +1,201 @@
+import hashlib
 import numpy as np
-import spacy
 
+from annotation import pipe_lemmas_and_tags
 from collections import Counter
-from sklearn.linear_model import LinearRegression
-from sklearn.metrics import mean_squared_error, r2_score
+from functools import reduce
+from multiprocessing import Pool
 
 # This file contains functions that perform feature extraction for the word-distribution method
 
 
-nlp = spacy.load("en_core_web_sm", disable=["parser", "ner"])
-nlp.add_pipe("sentencizer")
+def normalise_line(line):
+    """
+    Removes leading, trailing and extra whitespaces between words of a line
+    :param line: str
+    :return: str
+    """
+    return " ".join(line.split())
 
 
-def parse_book(path):
+def iter_lines(path):
     """
-    Reads file line by line and saves each line as a list of words in a set
+    Reads file line by line, yielding each normalised line
     :param path: str
-    :return: set <list<str>>
+    :return: generator <str>
     """
-    texts = []
     with open(path, mode="r", encoding="utf-8") as f:
         for line in f:
-            line = line.strip()  # Remove leading and trailing whitespaces
-            line = " ".join(line.split())  # Remove extra spaces between words
-            texts.append(line)
-    texts_set = set(texts)
-    return texts_set
+            yield normalise_line(line)
 
 
-def lemmatise_pipe(doc):
+def line_hash(line):
     """
-    Performs lemmatisation on a document
-    :param doc: generator
-    :return: list <str>
+    Hashes a line the same way in every process, unlike hash()
+    :param line: str
+    :return: bytes
     """
-    lemmas = [str(token.lemma_).lower() for token in doc
-              if token.is_alpha and not token.is_punct]
-    return lemmas
+    return hashlib.blake2b(line.encode("utf-8"), digest_size=8).digest()
 
 
-def preprocess_pipe(texts):
+def preprocess_pipe(texts, use_cache=False, as_generator=False):
     """
-    Executes lemmatisation in parallel by calling nlp.pipe() and working on batches of documents
-    :param texts:
+    Executes lemmatisation in parallel by calling nlp.pipe() and working on batches of documents.
+    With use_cache, lines found in the lemma cache are not parsed again
+    :param texts: iterable <str>
+    :param use_cache: bool
+    :param as_generator: bool, yield the lemmas of each text instead of returning a list
     :return: list <list<str>>
     """
-    lemmas_list = []
-    for doc in nlp.pipe(texts, batch_size=20):
-        lemmas_list.append(lemmatise_pipe(doc))
-    return lemmas_list
+    lemmas_lists = (lemmas_list for lemmas_list, _ in pipe_lemmas_and_tags(texts, batch_size=20, use_cache=use_cache))
+    if as_generator:
+        return lemmas_lists
+    return list(lemmas_lists)
 
 
-def collect_frequency(lemma_list):
+def fit_line(x, y):
     """
-    Counts occurrences of each word given a list and ranks them in popularity
-    :param lemma_list: list <list<str>>
-    :return: float, float
+    Performs linear regression in closed form to find the gradient, coefficient of determination,
+    and mean squared error, the same values as sklearn's LinearRegression, r2_score and mean_squared_error
+    :param x: numpy.ndarray <float>
+    :param y: numpy.ndarray <float>
+    :return: float, float, float
     """
-    final_counter = Counter()
-    for lemmas in lemma_list:
-        counts = Counter(lemmas)
-        final_counter.update(counts)  # Collect word occurrences
-    final_counter = final_counter.most_common()  # Rank the words by popularity
-
-    rank, freq = [], []
-    for i, (_, f) in enumerate(final_counter, start=1):
-        rank.append(i)
-        freq.append(f)
+    dx = x - x.mean()
+    dy = y - y.mean()
+    sxx = dx @ dx
+    slope = (dx @ dy) / sxx if sxx > 0 else 0.0
+    residuals = dy - slope * dx
+    ss_res = residuals @ residuals
+    ss_tot = dy @ dy
+
+    if len(y) < 2:
+        r2 = float("nan")  # Like r2_score, which is not defined for a single point
+    elif ss_tot > 0:
+        r2 = 1 - ss_res / ss_tot
+    else:
+        r2 = 1.0 if ss_res == 0 else 0.0
+    mse = ss_res / len(y)
+    return [float(slope), float(r2), float(mse)]
+
+
+class FrequencyTable:
+    def __init__(self, use_cache=False, shard=0, n_shards=1):
+        self.counts = Counter()  # Occurrences of each lemma
+        self.seen_lines = set()  # Hashes of the lines already counted, since every distinct line counts once
+        self.use_cache = use_cache  # Look up and keep the lemmas of every line in the lemma cache on disk
+        self.n_shards = n_shards  # Lines are split into n_shards shards by their hash
+        self.shards = {shard}  # Shards of the lines counted by the table, the lines of other shards are skipped
+        self.partial_line = ""  # End of the last text added, until a newline completes it
+
+    def in_shards(self, h):
+        """
+        Checks whether a line belongs to the shards counted by the table
+        :param h: bytes, hash of the line
+        :return: bool
+        """
+        return int.from_bytes(h, "big") % self.n_shards in self.shards
+
+    def add_lines(self, lines):
+        """
+        Lemmatises the lines of the shards of the table that have not been counted yet and adds their lemmas
+        :param lines: iterable <str>
+        :return: FrequencyTable
+        """
+        lines = (normalise_line(line) for line in lines)
+        new_lines = (line for line in lines if self.add_line_hash(line_hash(line)))
+        for lemmas_list in preprocess_pipe(new_lines, use_cache=self.use_cache, as_generator=True):
+            self.counts.update(lemmas_list)
+        return self
+
+    def add_line_hash(self, h):
+        """
+        Records the hash of a line, returning False if the line belongs to another shard or has already been counted
+        :param h: bytes
+        :return: bool
+        """
+        if h in self.seen_lines or not self.in_shards(h):
+            return False
+        self.seen_lines.add(h)
+        return True
+
+    def add_text(self, text, final=True):
+        """
+        Adds the lines of a text, e.g. text appended to a document that has already been counted.
+        With final=False, the text after the last newline is kept until the next text completes the line
+        :param text: str
+        :param final: bool, the text ends the document
+        :return: FrequencyTable
+        """
+        lines = (self.partial_line + text).split("\n")
+        self.partial_line = "" if final else lines.pop()
+        return self.add_lines(lines)
+
+    def merge(self, other):
+        """
+        Adds the counts of a table built from other shards of the same split, e.g. by another worker process.
+        Every line belongs to exactly one shard, so no line is counted twice
+        :param other: FrequencyTable
+        :return: FrequencyTable
+        """
+        if other.n_shards != self.n_shards or not self.shards.isdisjoint(other.shards):
+            raise ValueError("Only frequency tables counting distinct shards of the same split can be merged")
+        self.counts.update(other.counts)
+        self.seen_lines |= other.seen_lines
+        self.shards |= other.shards
+        return self
+
+    def features(self):
+        """
+        Fits log10(frequency) against log10(rank) of the lemmas ranked by popularity
+        :return: float, float, float
+        """
+        freq = np.sort(np.fromiter(self.counts.values(), dtype=float, count=len(self.counts)))[::-1]
+        if len(freq) == 0:
+            raise ValueError("No words to rank")
+        rank = np.log10(np.arange(1, len(freq) + 1))
+        return fit_line(rank, np.log10(freq))
+
+
+def count_shard(args):
+    """
+    Builds the frequency table of the lines of a file that belong to one shard
+    :param args: (str, int, int, bool)
+    :return: FrequencyTable
+    """
+    path, shard, n_shards, use_cache = args
+    return FrequencyTable(use_cache, shard, n_shards).add_lines(iter_lines(path))
 
-    # Return the log 10 of the ranks and frequency for linear regression
-    rank = np.log10(rank).reshape(-1, 1)
-    freq = np.log10(freq)
 
-    return rank, freq
+def parallel_frequency_table(path, n_shards=4, use_cache=False):
+    """
+    Builds the frequency table of a file on n_shards processes. Lines are split into shards by their hash,
+    so that every distinct line is counted by exactly one process
+    :param path: str
+    :param n_shards: int
+    :param use_cache: bool
+    :return: FrequencyTable
+    """
+    with Pool(n_shards) as pool:
+        tables = pool.map(count_shard, [(path, shard, n_shards, use_cache) for shard in range(n_shards)])
+    return reduce(FrequencyTable.merge, tables[1:], tables[0])
 
 
-def linear_regression(rank, freq_actual):
+def word_distribution_feature_extraction(path, use_cache=False):
     """
-    Performs linear regression given the x and y co-ordinates (rank and freq_actual)
-    to find the gradient, coefficient of determination, and mean squared error
-    :param rank: list <float>
-    :param freq_actual: list <float>
+    Extracts the gradient, coefficient of determination, and mean squared error of a text
+    :param path: str
+    :param use_cache: bool
     :return: float, float, float
     """
-    linear_reg = LinearRegression()
-    linear_reg.fit(rank, freq_actual)
-    freq_pred = linear_reg.predict(rank)  # Predict frequencies of each rank according to the regression line
+    table = FrequencyTable(use_cache).add_lines(iter_lines(path))
+    return table.features()
 
-    slope = linear_reg.coef_.item()
-    r2 = r2_score(freq_actual, freq_pred)
-    mse = mean_squared_error(freq_actual, freq_pred)
-    return [slope, r2, mse]
 
-
-def word_distribution_feature_extraction(path):
+def word_distribution_feature_extraction_from_text(text):
     """
-    Extracts the gradient, coefficient of determination, and mean squared error of a text
-    :param path: str
+    Extracts the gradient, coefficient of determination, and mean squared error of a text held in memory
+    :param text: str
     :return: float, float, float
     """
-    texts_set = parse_book(path)
-    lemmas_list = preprocess_pipe(texts_set)
-    rank, freq_actual = collect_frequency(lemmas_list)
-    features = linear_regression(rank, freq_actual)
-    return features
+    return FrequencyTable().add_text(text).features()
@@ -1,56 +1,73 @@
 import itertools
 import nltk
 import numpy as np
+import os
 import pickle
-import spacy
 
+from annotation import lemmatise_batch
 from collections import defaultdict
+from embedding_store import GLOVE_STORE, PRUNED_GLOVE_STORE, load_embedding_store, store_exists, \
+    write_embedding_store
+from functools import lru_cache
+from segmentation import split_into_paragraphs
 
 # This file contains functions that perform feature extraction for the word-embedding method
 
 nltk.download("punkt")  # For tokenising sentences
 nltk.download("averaged_perceptron_tagger")  # For POS tagging words
-nlp = spacy.load("en_core_web_sm", disable=["parser", "ner"])
 
+POS_TAGS = ["CC", "CD", "DT", "EX", "FW", "IN",
+            "JJ", "JJR", "JJS", "LS", "MD", "NN",
+            "NNS", "NNP", "NNPS", "PDT", "POS", "PRP",
+            "PRP$", "RB", "RBR", "RBS", "RP", "SYM",
+            "TO", "UH", "VB", "VBD", "VBG", "VBN",
+            "VBP", "VBZ", "WDT", "WP", "WP$", "WRB"]
+N_FEATURES = len(POS_TAGS) * (len(POS_TAGS) + 1)  # Mean and variance of every pos pair, 1332 features
 
-def split_into_paragraphs(path):
+
+def lemmatise(paragraph, use_cache=False):
     """
-    Splits a text file into list of paragraphs
-    :param path: str
+    Lemmatises every word in a text into its base form
+    :param paragraph: str
+    :param use_cache: bool
     :return: list <str>
     """
-    with open(path, mode="r", encoding="utf-8") as f:
-        text = f.read()
-        paragraphs = text.split("\n\n")
-        return [p.replace("\n", " ") for p in paragraphs]
+    lemmas, _ = lemmatise_batch([paragraph], use_cache)[0]
+    return lemmas
 
 
-def lemmatise(paragraph):
+def lemmatise_with_tags(paragraph, use_cache=False):
     """
-    Lemmatises every word in a text into its base form
+    Lemmatises every word in a text into its base form and finds its Penn Treebank tag
     :param paragraph: str
-    :return: list <str>
+    :param use_cache: bool
+    :return: list <str>, list <str>
     """
-    doc = nlp(paragraph)
-    lemmas = [str(token.lemma_).lower() for token in doc
-              if token.is_alpha and not token.is_punct]
-    return lemmas
+    return lemmatise_batch([paragraph], use_cache)[0]
 
 
-def save_glove_pkl(glove_txt="word_embedding/gloVe/gloVe.6B.50d.txt", glove_pkl="word_embedding/gloVe/gloVe_dict.pkl"):
+def read_glove_txt(glove_txt="word_embedding/gloVe/gloVe.6B.50d.txt"):
     """
-    Saves the GloVe word embeddings as a dict
+    Reads the GloVe word embeddings text file line by line
     :param glove_txt: str
-    :param glove_pkl: str
-    :return: None
+    :return: generator <str, numpy.ndarray<float>>
     """
-    embeddings_dict = {}
     with open(glove_txt, "r", encoding="utf-8") as file:
         for line in file:
             line_list = line.split()
             word = line_list[0]
             embedding = np.array(line_list[1:], dtype="float64")
-            embeddings_dict[word] = embedding
+            yield word, embedding
+
+
+def save_glove_pkl(glove_txt="word_embedding/gloVe/gloVe.6B.50d.txt", glove_pkl="word_embedding/gloVe/gloVe_dict.pkl"):
+    """
+    Saves the GloVe word embeddings as a dict
+    :param glove_txt: str
+    :param glove_pkl: str
+    :return: None
+    """
+    embeddings_dict = dict(read_glove_txt(glove_txt))
 
     with open(glove_pkl, "wb") as f:
         pickle.dump(embeddings_dict, f)
@@ -67,20 +84,90 @@ def read_glove_pkl(glove_pkl="word_embedding/gloVe/gloVe_dict.pkl"):
     return glove_dict
 
 
+def save_glove_store(glove_txt="word_embedding/gloVe/gloVe.6B.50d.txt", store_path=GLOVE_STORE):
+    """
+    Saves the GloVe word embeddings as a memory-mapped float32 matrix and a word index
+    :param glove_txt: str
+    :param store_path: str
+    :return: None
+    """
+    words, embeddings = zip(*read_glove_txt(glove_txt))
+    write_embedding_store(words, embeddings, store_path)
+
+
+def convert_glove_pkl(glove_pkl="word_embedding/gloVe/gloVe_dict.pkl", store_path=GLOVE_STORE):
+    """
+    Converts a GloVe word embeddings pickle file into a memory-mapped store
+    :param glove_pkl: str
+    :param store_path: str
+    :return: None
+    """
+    glove_dict = read_glove_pkl(glove_pkl)
+    write_embedding_store(list(glove_dict), list(glove_dict.values()), store_path)
+
+
+def collect_corpus_lemmas(roots=("dataset/english_chapters", "dataset/mt_french_chapters",
+                                  "dataset/mt_german_chapters", "dataset/mt_japanese_chapters")):
+    """
+    Finds every lemma used in the chapters of the corpus
+    :param roots: tuple <str>
+    :return: set <str>
+    """
+    lemmas = set()
+    for root in roots:
+        for sub_dir in os.scandir(root):
+            for file in os.scandir(sub_dir.path):
+                for p in split_into_paragraphs(file.path):
+                    lemmas.update(lemmatise(p, use_cache=True))
+    return lemmas
+
+
+def save_pruned_glove_store(corpus_lemmas, reserve=20000, dtype="float32",
+                            glove_txt="word_embedding/gloVe/gloVe.6B.50d.txt", store_path=PRUNED_GLOVE_STORE):
+    """
+    Saves only the GloVe word embeddings used by the corpus, plus the most frequent words as a reserve
+    for unseen texts. GloVe lists its words from most to least frequent, so the reserve is the first rows
+    :param corpus_lemmas: set <str>
+    :param reserve: int
+    :param dtype: str, "float32" or "float16"
+    :param glove_txt: str
+    :param store_path: str
+    :return: None
+    """
+    words = []
+    embeddings = []
+    for i, (word, embedding) in enumerate(read_glove_txt(glove_txt)):
+        if i < reserve or word in corpus_lemmas:
+            words.append(word)
+            embeddings.append(embedding)
+    write_embedding_store(words, embeddings, store_path, dtype=dtype)
+
+
+@lru_cache(maxsize=None)
+def get_glove_store(store_path=GLOVE_STORE, glove_txt="word_embedding/gloVe/gloVe.6B.50d.txt"):
+    """
+    Loads a GloVe embedding store, building the full store from the text file the first time.
+    The full store is the default. The pruned store of save_pruned_glove_store() lacks the words
+    outside the corpus, so it is only used when its path is given, for evaluation on the corpus
+    :param store_path: str
+    :param glove_txt: str
+    :return: EmbeddingStore
+    """
+    if store_path == PRUNED_GLOVE_STORE and not store_exists(store_path):
+        raise FileNotFoundError("Run save_pruned_glove_store() to build the pruned store first")
+    if not store_exists(store_path):
+        save_glove_store(glove_txt, store_path)
+    return load_embedding_store(store_path)
+
+
 def init_pos_dict():
     """
     Initialises a dictionary with pos pairs as keys
     :return: dict
     """
     pos_pairs_dict = defaultdict(list)
-    pos_tags = ["CC", "CD", "DT", "EX", "FW", "IN",
-                "JJ", "JJR", "JJS", "LS", "MD", "NN",
-                "NNS", "NNP", "NNPS", "PDT", "POS", "PRP",
-                "PRP$", "RB", "RBR", "RBS", "RP", "SYM",
-                "TO", "UH", "VB", "VBD", "VBG", "VBN",
-                "VBP", "VBZ", "WDT", "WP", "WP$", "WRB"]
-    for tag1 in pos_tags:
-        for tag2 in pos_tags:
+    for tag1 in POS_TAGS:
+        for tag2 in POS_TAGS:
             pos_pairs_dict[frozenset((tag1, tag2))] = []
     return pos_pairs_dict
 
@@ -112,17 +199,129 @@ def get_variance(np_array):
         return np.var(np_array)
 
 
-def word_embedding_feature_extraction(lemmas):
+def get_pairwise_distances(embeddings):
+    """
+    Finds the euclidean distance between every pair of rows in a matrix
+    :param embeddings: numpy.ndarray <float>
+    :return: numpy.ndarray <float>
+    """
+    squared_norms = np.einsum("ij,ij->i", embeddings, embeddings)
+    squared_distances = squared_norms[:, None] + squared_norms[None, :] - 2 * (embeddings @ embeddings.T)
+    np.maximum(squared_distances, 0, out=squared_distances)  # Remove negative rounding errors
+    np.fill_diagonal(squared_distances, 0)  # A word is always at distance 0 from itself
+    return np.sqrt(squared_distances)
+
+
+@lru_cache(maxsize=32)
+def get_sorted_pos_pairs(extra_pos_pairs=()):
+    """
+    Orders the pos pairs the same way sorting the dictionary from init_pos_dict() does,
+    with pos pairs of unknown tags appended in the order they were first seen
+    :param extra_pos_pairs: tuple <frozenset<str>>
+    :return: list <int>
+    """
+    pos_pairs = list(init_pos_dict()) + list(extra_pos_pairs)
+    return sorted(range(len(pos_pairs)), key=pos_pairs.__getitem__)
+
+
+def word_embedding_feature_extraction(lemmas, glove_dict=None):
+    """
+    Performs feature extraction on a paragraph.
+    The distances between all pairs of words are computed at once and grouped by their pos pair.
+    Words are tagged with nltk, as they were when the classifier was trained
+    :param lemmas: list <str>
+    :param glove_dict: dict or EmbeddingStore or NoneType
+    :return: list <float>, list <float>
+    """
+    pos_tagged_paragraph = nltk.pos_tag(lemmas)
+    if glove_dict is None:
+        glove_dict = get_glove_store()  # Stores the word embedding for each word
+
+    # Look up the embedding of each distinct word once, leaving out words without an embedding
+    tag_ids = {tag: i for i, tag in enumerate(POS_TAGS)}
+    word_rows = {}
+    embeddings = []
+    rows = []
+    tags = []
+    for word, tag in pos_tagged_paragraph:
+        if word not in word_rows:
+            embedding = glove_dict.get(word)
+            word_rows[word] = None if embedding is None else len(embeddings)
+            if embedding is not None:
+                embeddings.append(embedding)
+        if word_rows[word] is not None:
+            rows.append(word_rows[word])
+            tags.append(tag_ids.setdefault(tag, len(tag_ids)))
+
+    # Map every pair of tags to its pos pair, numbered in the order of init_pos_dict()
+    base_pos_pairs = list(init_pos_dict())
+    n_tags = len(tag_ids)
+    pair_ids = np.zeros((n_tags, n_tags), dtype=np.intp)
+    for i, pos_pair in enumerate(base_pos_pairs):
+        tag1, tag2 = tuple(pos_pair) * 2 if len(pos_pair) == 1 else tuple(pos_pair)
+        pair_ids[tag_ids[tag1], tag_ids[tag2]] = pair_ids[tag_ids[tag2], tag_ids[tag1]] = i
+
+    # Compute the distance of every pair of words, in the same order as itertools.combinations
+    rows = np.array(rows, dtype=np.intp)
+    tags = np.array(tags, dtype=np.intp)
+    first, second = np.triu_indices(len(rows), k=1)
+    distance_matrix = get_pairwise_distances(np.array(embeddings, dtype="float64") if embeddings else np.zeros((0, 0)))
+    distances = distance_matrix[rows[first], rows[second]]
+    first_tags = tags[first]
+    second_tags = tags[second]
+
+    # Tags outside POS_TAGS create new pos pairs in the order they are first seen
+    extra_pos_pairs = []
+    unknown = (first_tags >= len(POS_TAGS)) | (second_tags >= len(POS_TAGS))
+    if unknown.any():
+        codes = np.minimum(first_tags, second_tags)[unknown] * n_tags + np.maximum(first_tags, second_tags)[unknown]
+        unique_codes, first_seen = np.unique(codes, return_index=True)
+        tag_names = list(tag_ids)
+        for code in unique_codes[np.argsort(first_seen)]:
+            tag1, tag2 = divmod(int(code), n_tags)
+            pair_ids[tag1, tag2] = pair_ids[tag2, tag1] = len(base_pos_pairs) + len(extra_pos_pairs)
+            extra_pos_pairs.append(frozenset((tag_names[tag1], tag_names[tag2])))
+
+    n_pos_pairs = len(base_pos_pairs) + len(extra_pos_pairs)
+    pos_pairs = pair_ids[first_tags, second_tags]
+    same_tag = first_tags == second_tags
+
+    # If both words have the same POS tag, preserve the minimum distance
+    minimums = np.full(n_pos_pairs, np.inf)
+    np.minimum.at(minimums, pos_pairs[same_tag], distances[same_tag])
+
+    # Otherwise, calculate the mean and variance of the distances
+    different_pos_pairs = pos_pairs[~same_tag]
+    different_distances = distances[~same_tag]
+    counts = np.bincount(different_pos_pairs, minlength=n_pos_pairs)
+    sums = np.bincount(different_pos_pairs, weights=different_distances, minlength=n_pos_pairs)
+    means = np.divide(sums, counts, out=np.zeros(n_pos_pairs), where=counts > 0)
+    deviations = different_distances - means[different_pos_pairs]
+    squared_deviations = np.bincount(different_pos_pairs, weights=deviations * deviations, minlength=n_pos_pairs)
+    variances = np.divide(squared_deviations, counts, out=np.zeros(n_pos_pairs), where=counts > 0)
+
+    has_minimum = np.isfinite(minimums)
+    means[has_minimum] = minimums[has_minimum]
+    variances[has_minimum] = 0.0
+
+    order = get_sorted_pos_pairs(tuple(extra_pos_pairs))
+    return [means[order].tolist(), variances[order].tolist()]
+
+
+def word_embedding_feature_extraction_loop(lemmas, glove_dict=None):
     """
-    Performs feature extraction on a paragraph
+    Performs feature extraction on a paragraph by comparing each pair of words in turn.
+    This is the reference implementation of word_embedding_feature_extraction
     :param lemmas: list <str>
+    :param glove_dict: dict or NoneType
     :return: list <float>, list <float>
     """
     pos_tagged_paragraph = nltk.pos_tag(lemmas)
 
     # Compare similarity between each pair of words and store it on the appropriate group dictionary
     pos_dict = init_pos_dict()  # Stores distance of different combinations of pos pairs
-    glove_dict = read_glove_pkl()  # Stores the word embedding for each word
+    if glove_dict is None:
+        glove_dict = read_glove_pkl()  # Stores the word embedding for each word
 
     for pos_pair1, pos_pair2 in itertools.combinations(pos_tagged_paragraph, 2):
         first_word = pos_pair1[0]